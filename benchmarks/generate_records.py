@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""Generate seeded synthetic Senzing JSONL records for benchmarking the extraction pipeline."""
+
+import argparse
+import json
+import os
+import random
+import re
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CONFIG_FILE = os.path.join(BENCHMARK_PATH, "..", "src", "geo_extractor_config.json")
+
+RECORD_TYPES = (("PERSON", 0.55), ("ORGANIZATION", 0.35), ("VESSEL", 0.04), ("AIRCRAFT", 0.01), ("", 0.05))
+ADDRESS_LABELS = ("", "", "", "BUSINESS", "HOME", "MAILING")
+
+OTHER_CITIES = ("Paris", "Berlin", "Springfield", "Lagos", "São Paulo", "Zürich", "Sydney", "Nairobi", "Lima")
+OTHER_STATES = ("Île-de-France", "Bavaria", "IL", "TX", "New South Wales", "Lagos State", "")
+OTHER_COUNTRIES = ("FR", "France", "DE", "Germany", "US", "Brazil", "CH", "Australia", "NG", "Peru", "")
+OTHER_POSTAL_CODES = ("75001", "10115", "62701", "2000", "8001", "")
+STREETS = ("Main St", "High Street", "Rue de la Paix", "Market Rd", "Harbour View", "Station Road")
+FIRST_NAMES = ("Anna", "Bob", "Chen", "Dmitri", "Elena", "Farid", "Grace", "Hiro", "Ines", "José", "Kofi", "Zoë")
+LAST_NAMES = ("Smith", "Ivanov", "Wang", "Haddad", "Garcia", "Okafor", "Müller", "Borg", "Tan", "Rezaei")
+ORG_WORDS = ("Holdings", "Trading", "Shipping", "Capital", "Logistics", "Ventures", "Group", "Partners")
+
+
+class RecordGenerator:
+    """Seeded source of Senzing style records with a configurable share of addresses in the target geos.
+
+    Addresses mix ADDR_FULL strings with parsed fields, are sometimes keyed with usage labels such as
+    BUSINESS_ADDR_CITY and are either at the root of a record or nested in an ADDRESSES list.
+    """
+
+    def __init__(self, geos, seed=1, hit_rate=0.1, addr_full_rate=0.4):
+        self.random = random.Random(seed)
+        self.geos = [geo_config for geo_config in geos.values() if geo_config.get("cities") or geo_config.get("states")]
+        self.hit_rate = hit_rate
+        self.addr_full_rate = addr_full_rate
+
+    def pick(self, values, blank_rate=0.0):
+        """Return a random value, or an empty string at the blank rate."""
+        if not values or self.random.random() < blank_rate:
+            return ""
+        return self.random.choice(values)
+
+    def address_values(self):
+        """Return the (city, state, postal code, country) of an address, in a target geo at the hit rate."""
+        if self.geos and self.random.random() < self.hit_rate:
+            geo_config = self.random.choice(self.geos)
+            postal_code = self.pick(geo_config.get("postal_codes", []))
+            if postal_code:
+                postal_code = f"{postal_code}{self.random.randint(1, 9)} {self.random.randint(1, 9)}AA"
+            return (
+                self.pick(geo_config.get("cities", [])).title(),
+                self.pick(geo_config.get("states", []), 0.3).upper(),
+                postal_code.upper(),
+                self.pick(geo_config.get("countries", []), 0.2).upper(),
+            )
+        return (
+            self.pick(OTHER_CITIES),
+            self.pick(OTHER_STATES, 0.3),
+            self.pick(OTHER_POSTAL_CODES, 0.2),
+            self.pick(OTHER_COUNTRIES, 0.2),
+        )
+
+    def address(self, label=""):
+        """Return the attributes of an address, either as ADDR_FULL or as parsed fields."""
+        city, state, postal_code, country = self.address_values()
+        street = f"{self.random.randint(1, 999)} {self.random.choice(STREETS)}"
+        if self.random.random() < self.addr_full_rate:
+            address = {"ADDR_FULL": ", ".join(value for value in (street, city, state, postal_code, country) if value)}
+        else:
+            address = {
+                "ADDR_LINE1": street,
+                "ADDR_CITY": city,
+                "ADDR_STATE": state,
+                "ADDR_POSTAL_CODE": postal_code,
+                "ADDR_COUNTRY": country,
+            }
+        if not label:
+            return address
+        if self.random.random() < 0.5:
+            return {f"{label}_{key}": value for key, value in address.items()}
+        return {**address, "ADDR_TYPE": label}
+
+    def name(self, record_type):
+        """Return the name attributes of a record."""
+        if record_type in ("ORGANIZATION", "VESSEL", "AIRCRAFT"):
+            return {"NAME_ORG": f"{self.random.choice(LAST_NAMES)} {self.random.choice(ORG_WORDS)}"}
+        if self.random.random() < 0.5:
+            return {"NAME_FULL": f"{self.random.choice(FIRST_NAMES)} {self.random.choice(LAST_NAMES)}"}
+        return {"NAME_FIRST": self.random.choice(FIRST_NAMES), "NAME_LAST": self.random.choice(LAST_NAMES)}
+
+    def record(self, record_id):
+        """Return a record with a name, zero or more addresses and a few other features."""
+        record_type = self.random.choices(*zip(*RECORD_TYPES))[0]
+        record = {"DATA_SOURCE": "BENCHMARK", "RECORD_ID": str(record_id)}
+        if record_type:
+            record["RECORD_TYPE"] = record_type
+        if self.random.random() < 0.8:
+            record.update(self.name(record_type))
+        else:
+            record["NAMES"] = [self.name(record_type) for _ in range(self.random.randint(1, 3))]
+
+        layout = self.random.random()
+        if layout < 0.35:
+            record.update(self.address(self.random.choice(ADDRESS_LABELS)))
+        elif layout < 0.9:
+            record["ADDRESSES"] = [
+                self.address(self.random.choice(ADDRESS_LABELS)) for _ in range(self.random.randint(1, 3))
+            ]
+
+        if record_type == "PERSON" and self.random.random() < 0.6:
+            record["DATE_OF_BIRTH"] = f"{self.random.randint(1940, 2005)}-{self.random.randint(1, 12):02}-01"
+        if self.random.random() < 0.5:
+            record["PHONES"] = [
+                {"PHONE_NUMBER": f"+{self.random.randint(1, 99)} {self.random.randint(1000000, 9999999)}"}
+            ]
+        if self.random.random() < 0.3:
+            record["EMAIL_ADDRESS"] = f"info{record_id}@example.com"
+        if self.random.random() < 0.2:
+            record["IDENTIFIERS"] = [{"PASSPORT_NUMBER": f"P{self.random.randint(100000, 999999)}"}]
+        return record
+
+    def lines(self, record_cnt):
+        """Yield record_cnt records as JSONL lines, some with escaped non-ASCII characters."""
+        for record_id in range(1, record_cnt + 1):
+            record = self.record(record_id)
+            yield json.dumps(record, ensure_ascii=self.random.random() < 0.2) + "\n"
+
+
+def load_geos(config_file):
+    """Return the active target geos of a geo_extractor config file, which may contain comments."""
+    with open(config_file, "r", encoding="utf-8") as f:
+        config_text = re.sub(r"""("(?:\\"|[^"])*?")|(\/\*[\s\S]*?\*\/|\/\/.*)""", r"\1", f.read())
+    target_geos = json.loads(config_text)["target_geos"]
+    return {geo: geo_config for geo, geo_config in target_geos.items() if not geo.startswith("inactive")}
+
+
+def main():
+    """Write the requested number of synthetic records to a JSONL file."""
+    arg_parser = argparse.ArgumentParser(allow_abbrev=False, description="Generate synthetic Senzing JSONL records")
+    arg_parser.add_argument("output_file", help="JSONL file to write")
+    arg_parser.add_argument("-n", "--records", default=100_000, dest="records", metavar="int", type=int)
+    arg_parser.add_argument("-s", "--seed", default=1, dest="seed", metavar="int", type=int)
+    arg_parser.add_argument(
+        "--hit-rate",
+        default=0.1,
+        dest="hit_rate",
+        metavar="float",
+        type=float,
+        help="share of addresses placed in a target geo, default = %(default)s",
+    )
+    arg_parser.add_argument(
+        "--addr-full-rate",
+        default=0.4,
+        dest="addr_full_rate",
+        metavar="float",
+        type=float,
+        help="share of addresses given as ADDR_FULL rather than parsed fields, default = %(default)s",
+    )
+    arg_parser.add_argument("-c", "--config", default=DEFAULT_CONFIG_FILE, dest="config_file", help="geo config file")
+    cli_args = arg_parser.parse_args()
+
+    record_generator = RecordGenerator(
+        load_geos(cli_args.config_file), cli_args.seed, cli_args.hit_rate, cli_args.addr_full_rate
+    )
+    with open(cli_args.output_file, "w", encoding="utf-8") as f:
+        f.writelines(record_generator.lines(cli_args.records))
+
+
+if __name__ == "__main__":
+    main()
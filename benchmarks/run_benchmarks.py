@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""Benchmark the record parser, the geo matchers and end to end extraction on synthetic records."""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from generate_records import RecordGenerator
+
+import geo_extractor
+from geo_matcher import MATCH_FUNCTIONS, GeoMatcher, GeoPrefilter
+from json2attribute import json2attribute
+
+try:
+    import resource
+except ImportError:  # pragma: no cover - not available on Windows
+    resource = None  # type: ignore[assignment]
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+
+
+def best_time(func, repeat):
+    """Return the fastest of repeat timed calls of func."""
+    elapsed_times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func()
+        elapsed_times.append(time.perf_counter() - start_time)
+    return min(elapsed_times)
+
+
+def rate(item_cnt, seconds, item_name="records"):
+    """Return a benchmark result for item_cnt items processed in seconds."""
+    return {item_name: item_cnt, "seconds": round(seconds, 6), f"{item_name}_per_sec": round(item_cnt / seconds, 1)}
+
+
+def peak_bytes(func, item_cnt):
+    """Return the peak bytes traced per item while calling func, which holds on to what it returns."""
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return round(peak / item_cnt, 1)
+
+
+def peak_rss_kb(rusage):
+    """Return the peak resident set size of a resource usage in KiB, which macOS reports in bytes."""
+    return rusage.ru_maxrss // 1024 if sys.platform == "darwin" else rusage.ru_maxrss
+
+
+def bench_parser(lines, repeat):
+    """Time loading the Senzing config, with and without its compiled cache, and the parse paths of json2attribute."""
+    json_parser = json2attribute(geo_extractor.SENZING_CONFIG_FILE)
+    load_cnt = 200
+    results = {
+        "json2attribute()": rate(
+            load_cnt,
+            best_time(lambda: [json2attribute(geo_extractor.SENZING_CONFIG_FILE) for _ in range(load_cnt)], repeat),
+            "loads",
+        ),
+        "json2attribute(compiled_dir=None)": rate(
+            load_cnt,
+            best_time(
+                lambda: [json2attribute(geo_extractor.SENZING_CONFIG_FILE, compiled_dir=None) for _ in range(load_cnt)],
+                repeat,
+            ),
+            "loads",
+        ),
+        "json2attribute.parse": rate(len(lines), best_time(lambda: [json_parser.parse(x) for x in lines], repeat)),
+        "json2attribute.parse_records": rate(
+            len(lines), best_time(lambda: [json_parser.parse_records(x) for x in lines], repeat)
+        ),
+        "json2attribute.extract": rate(
+            len(lines),
+            best_time(lambda: [list(json_parser.extract(x, ("RECORD_TYPE", "ADDRESS"))) for x in lines], repeat),
+        ),
+        "json2attribute.features": rate(
+            len(lines), best_time(lambda: [list(json_parser.features(x)) for x in lines], repeat)
+        ),
+    }
+    results["json2attribute.parse"]["peak_bytes_per_record"] = peak_bytes(
+        lambda: [json_parser.parse(x) for x in lines], len(lines)
+    )
+    results["json2attribute.parse_records"]["peak_bytes_per_record"] = peak_bytes(
+        lambda: [json_parser.parse_records(x) for x in lines], len(lines)
+    )
+    return results
+
+
+def bench_matchers(lines, config, repeat):
+    """Time each geo's match function, the compiled matcher over all geos, one address and one batch at a time, and the prefilter."""
+    json_parser = geo_extractor.load_parser(config.senzing_config_file)
+    addr_list = [
+        geo_extractor.normalize_address(attr_data["ATTR_JSON"])
+        for line in lines
+        for attr_data in json_parser.extract(line, ("ADDRESS",))
+    ]
+    results = {}
+    for geo, geo_config in config.geos.items():
+        match_function = MATCH_FUNCTIONS[geo_config["function"]]
+        seconds = best_time(lambda f=match_function, g=geo_config: [f(g, x) for x in addr_list], repeat)
+        results[f"{geo_config['function']}[{geo}]"] = rate(len(addr_list), seconds, "addresses")
+    geo_matcher = GeoMatcher(config.geos, list(config.geos))
+    results["GeoMatcher.match[all]"] = rate(
+        len(addr_list), best_time(lambda: [geo_matcher.match(x) for x in addr_list], repeat), "addresses"
+    )
+    batch_size = geo_extractor.DEFAULT_BATCH_SIZE
+    results["GeoMatcher.match_batch[all]"] = rate(
+        len(addr_list),
+        best_time(
+            lambda: [
+                geo_matcher.match_batch(addr_list[i : i + batch_size]) for i in range(0, len(addr_list), batch_size)
+            ],
+            repeat,
+        ),
+        "addresses",
+    )
+    try:
+        geo_prefilter = GeoPrefilter(config.geos, list(config.geos))
+    except ValueError:
+        return results
+    encoded_lines = [line.encode() for line in lines]
+    results["GeoPrefilter.may_match[all]"] = rate(
+        len(lines), best_time(lambda: [geo_prefilter.may_match(x) for x in encoded_lines], repeat)
+    )
+    return results
+
+
+def bench_pipeline(lines, config, repeat):
+    """Time the GeoExtractor stages over all geos in process, without any file output."""
+    encoded_lines = [line.encode() for line in lines]
+    json_parser = geo_extractor.load_parser(config.senzing_config_file)
+    return {
+        "GeoExtractor.extract[all]": rate(
+            len(lines),
+            best_time(
+                lambda: list(geo_extractor.GeoExtractor(config, json_parser=json_parser).extract(encoded_lines)),
+                repeat,
+            ),
+        )
+    }
+
+
+def bench_extractor(source_file, target_geos, temp_path, extract_args, repeat):
+    """Time geo_extractor.py extracting all geos from the source file in a child process, with its peak RSS."""
+    bench_config_file = os.path.join(temp_path, "geo_extractor_config.json")
+    with open(bench_config_file, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "output_path": os.path.join(temp_path, "output"),
+                "source_files": {"benchmark": source_file},
+                "target_geos": target_geos,
+            },
+            f,
+        )
+    os.makedirs(os.path.join(temp_path, "output"), exist_ok=True)
+    command = [sys.executable, geo_extractor.__file__, "benchmark", "all", "-o", "1000000000"]
+    command.extend(extract_args)
+    best_result = {}
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        with subprocess.Popen(  # nosec B603 - runs this repository's own script
+            command, env={**os.environ, "GEO_EXTRACTOR_CONFIG": bench_config_file}, stdout=subprocess.DEVNULL
+        ) as process:
+            _, exit_status, rusage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(exit_status)
+        seconds = time.perf_counter() - start_time
+        if process.returncode:
+            raise RuntimeError(f"{' '.join(command)} exited with {process.returncode}")
+        if not best_result or seconds < best_result["seconds"]:
+            with open(source_file, "rb") as f:
+                line_cnt = sum(1 for _ in f)
+            best_result = rate(line_cnt, seconds)
+            best_result["bytes_per_sec"] = round(os.path.getsize(source_file) / seconds, 1)
+            best_result["peak_rss_kb"] = peak_rss_kb(rusage)
+    best_result["args"] = extract_args
+    return best_result
+
+
+def git_version():
+    """Return the git description of the working tree, if there is one."""
+    try:
+        return subprocess.run(  # nosec B603 B607 - fixed git command
+            ["git", "describe", "--always", "--tags", "--dirty"],
+            capture_output=True,
+            check=True,
+            cwd=BENCHMARK_PATH,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def main():
+    """Generate the benchmark records, run the benchmarks and write their results to a JSON file."""
+    arg_parser = argparse.ArgumentParser(allow_abbrev=False, description="Benchmark the geo extraction pipeline")
+    arg_parser.add_argument("-n", "--records", default=20_000, dest="records", metavar="int", type=int)
+    arg_parser.add_argument("-s", "--seed", default=1, dest="seed", metavar="int", type=int)
+    arg_parser.add_argument("--hit-rate", default=0.1, dest="hit_rate", metavar="float", type=float)
+    arg_parser.add_argument("--addr-full-rate", default=0.4, dest="addr_full_rate", metavar="float", type=float)
+    arg_parser.add_argument("-r", "--repeat", default=3, dest="repeat", metavar="int", type=int)
+    arg_parser.add_argument(
+        "-x",
+        "--extract-args",
+        default="",
+        dest="extract_args",
+        help='extra geo_extractor.py arguments for the end to end run, e.g. -x="-w 4 --prefilter"',
+    )
+    arg_parser.add_argument(
+        "-o", "--output", default="benchmark_results.json", dest="output_file", help="JSON file to write results to"
+    )
+    cli_args = arg_parser.parse_args()
+
+    # The geos are those geo_extractor.py loads, so set GEO_EXTRACTOR_CONFIG to benchmark another config
+    config = geo_extractor.load_config()
+    record_generator = RecordGenerator(config.geos, cli_args.seed, cli_args.hit_rate, cli_args.addr_full_rate)
+    lines = list(record_generator.lines(cli_args.records))
+
+    results = {}
+    print("benchmarking json2attribute ...", flush=True)
+    results.update(bench_parser(lines, cli_args.repeat))
+    print("benchmarking geo matching ...", flush=True)
+    results.update(bench_matchers(lines, config, cli_args.repeat))
+    print("benchmarking the extraction pipeline ...", flush=True)
+    results.update(bench_pipeline(lines, config, cli_args.repeat))
+    print("benchmarking geo_extractor.py ...", flush=True)
+    with tempfile.TemporaryDirectory() as temp_path:
+        source_file = os.path.join(temp_path, "benchmark.jsonl")
+        with open(source_file, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+        results["geo_extractor"] = bench_extractor(
+            source_file, config.geos, temp_path, cli_args.extract_args.split(), cli_args.repeat
+        )
+
+    benchmark_report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "version": git_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "parameters": {
+            "config": os.path.abspath(geo_extractor.APP_CONFIG_FILE),
+            "records": cli_args.records,
+            "seed": cli_args.seed,
+            "hit_rate": cli_args.hit_rate,
+            "addr_full_rate": cli_args.addr_full_rate,
+            "repeat": cli_args.repeat,
+        },
+        "peak_rss_kb": peak_rss_kb(resource.getrusage(resource.RUSAGE_SELF)) if resource else None,
+        "results": results,
+    }
+    with open(cli_args.output_file, "w", encoding="utf-8") as f:
+        json.dump(benchmark_report, f, indent=4)
+    for name, result in results.items():
+        rate_name = next(key for key in result if key.endswith("_per_sec"))
+        print(f"\t{name:<40} {result[rate_name]:>14,.1f} {rate_name.replace('_', ' ')}")
+    print(f"\nresults written to {cli_args.output_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Checkpoints of how far an extraction has got, so an interrupted run can be resumed."""
+
+import glob
+import os
+import time
+
+import orjson
+
+from geo_index import source_signature
+from run_stats import merge_stats, new_stats
+
+CHECKPOINT_VERSION = 2
+
+
+def load_checkpoint(checkpoint_file):
+    """Return the data saved in a checkpoint file, or None if there is no usable checkpoint."""
+    try:
+        with open(checkpoint_file, "rb") as f:
+            checkpoint_data = orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+    if checkpoint_data.get("version") != CHECKPOINT_VERSION:
+        return None
+    return checkpoint_data
+
+
+def save_checkpoint(checkpoint_file, checkpoint_data):
+    """Write a checkpoint file atomically, so a crash leaves either the previous or the new checkpoint."""
+    with open(checkpoint_file + ".part", "wb") as f:
+        f.write(orjson.dumps({"version": CHECKPOINT_VERSION, **checkpoint_data}))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(checkpoint_file + ".part", checkpoint_file)
+
+
+def remove_checkpoint(checkpoint_file):
+    """Delete a checkpoint file and any unfinished write of it."""
+    for file_name in (checkpoint_file, checkpoint_file + ".part"):
+        if os.path.exists(file_name):
+            os.remove(file_name)
+
+
+def remove_checkpoints(checkpoint_file):
+    """Delete a source's checkpoint file along with the checkpoints of its shards."""
+    for file_name in glob.glob(glob.escape(checkpoint_file) + ".shard*"):
+        os.remove(file_name)
+    remove_checkpoint(checkpoint_file)
+
+
+class RangeCheckpoint:
+    """Periodically saved position of the extraction of a byte range of a source, with its stats.
+
+    The target writers are flushed before each save so the recorded output sizes cover exactly the
+    lines read before the saved position. Resuming truncates the outputs back to those sizes and
+    reads on from the position, so no output line is lost, repeated or cut short.
+    """
+
+    def __init__(self, checkpoint_file, interval_secs, range_stats, target_writers):
+        self.checkpoint_file = checkpoint_file
+        self.interval_secs = interval_secs
+        self.range_stats = range_stats
+        self.target_writers = target_writers
+        self.next_time = time.monotonic() + interval_secs
+
+    def save(self, position, done=False):
+        """Record that every line before position has been extracted, or with done that the whole range has."""
+        outputs = {geo: target_writer.checkpoint() for geo, target_writer in self.target_writers.items()}
+        save_checkpoint(
+            self.checkpoint_file, {"position": position, "done": done, "stats": self.range_stats, "outputs": outputs}
+        )
+        self.next_time = time.monotonic() + self.interval_secs
+
+    def save_when_due(self, position):
+        """Save the checkpoint if the interval since the last save has passed."""
+        if time.monotonic() >= self.next_time:
+            self.save(position)
+
+    def resume(self, checkpoint_data):
+        """Truncate the target writers' temporary files back to a checkpoint and continue appending to them."""
+        for geo, target_writer in self.target_writers.items():
+            target_writer.resume(*checkpoint_data["outputs"][geo])
+
+
+def source_checkpoint(checkpoint_file, source_file, target_files, shards, options):
+    """Return the checkpoint to extract a source in (start, end) shards under.
+
+    With --resume this is the checkpoint the last run saved, as long as the source and target files
+    are unchanged, otherwise a new checkpoint is saved over it and its shards' checkpoints removed.
+    Raises ValueError when resuming with one worker from multiple workers' checkpoint or vice versa.
+    """
+    sharded = options.workers > 1
+    checkpoint_data = load_checkpoint(checkpoint_file) if options.resume else None
+    if (
+        checkpoint_data
+        and checkpoint_data["source"] == source_signature(source_file)
+        and checkpoint_data["target_files"] == target_files
+    ):
+        if checkpoint_data["sharded"] != sharded:
+            workers = "multiple workers" if checkpoint_data["sharded"] else "a single worker"
+            raise ValueError(f"{checkpoint_file} was saved extracting with {workers}, resume it the same way")
+        return checkpoint_data
+    if checkpoint_data:
+        print(f"\nWARNING: {source_file} or its target files changed since it was checkpointed, starting over")
+    remove_checkpoints(checkpoint_file)
+    checkpoint_data = {
+        "source": source_signature(source_file),
+        "target_files": target_files,
+        "sharded": sharded,
+        "shards": shards,
+        "merged": [],
+        "outputs": {},
+        "stats": new_stats(target_files),
+    }
+    save_checkpoint(checkpoint_file, checkpoint_data)
+    return checkpoint_data
+
+
+def checkpoint_merge(checkpoint_file, checkpoint_data, shard_idx, shard_stats, target_writers):
+    """Save that a shard has been appended to the target files, then drop the shard's own checkpoint."""
+    checkpoint_data["merged"].append(shard_idx)
+    checkpoint_data["outputs"] = {geo: target_writer.checkpoint() for geo, target_writer in target_writers.items()}
+    merge_stats(checkpoint_data["stats"], shard_stats)
+    save_checkpoint(checkpoint_file, checkpoint_data)
+    remove_checkpoint(f"{checkpoint_file}.shard{shard_idx}")
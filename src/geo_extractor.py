@@ -2,20 +2,63 @@
 """Extract geographically-located records from Senzing JSONL files."""
 
 import argparse
+import cProfile
+import functools
+import hashlib
+import itertools
 import json
 import os
 import re
 import sys
 import time
-from typing import Any
 
+from checkpoint import (
+    RangeCheckpoint,
+    load_checkpoint,
+    remove_checkpoints,
+    source_checkpoint,
+)
+from geo_index import GeoIndex
+from geo_matcher import MATCH_FUNCTIONS, GeoMatcher, GeoPrefilter, country_matches
+from heavy_hitters import add_value, new_summary
 from json2attribute import json2attribute
+from run_stats import (
+    add_queue_depths,
+    format_queue_depths,
+    merge_stats,
+    new_stats,
+    print_profile,
+    print_summary,
+    progress_rates,
+    write_country_logs,
+    write_stats_json,
+)
+from shard_pool import extract_shards
+from stage_timer import (
+    format_stage_times,
+    lap_function,
+)
+from stream_io import (
+    COMPRESSION_EXTENSIONS,
+    DEFAULT_FLUSH_SIZE,
+    DEFAULT_QUEUE_DEPTH,
+    ChunkReader,
+    OutputWriter,
+    WriteQueue,
+    detect_compression,
+    open_source,
+    seek_source,
+    zstandard,
+)
 
 APP_PATH = os.path.dirname(__file__) + os.path.sep
 SENZING_CONFIG_FILE = APP_PATH + "sz_default_config.json"
-APP_CONFIG_FILE = APP_PATH + "geo_extractor_config.json"
+APP_CONFIG_FILE = os.environ.get("GEO_EXTRACTOR_CONFIG", APP_PATH + "geo_extractor_config.json")
 
-json_parser = json2attribute(SENZING_CONFIG_FILE)
+VALID_RECORD_TYPES = ("PERSON", "ORGANIZATION")
+INDEX_ADDR_KEYS = ("ADDR_FULL", "ADDR_CITY", "ADDR_STATE", "ADDR_POSTAL_CODE", "ADDR_COUNTRY")
+DEFAULT_BATCH_SIZE = 256
+DEFAULT_COUNTRY_LOG_SIZE = 1000
 
 
 class JSONWithComments(json.JSONDecoder):
@@ -30,248 +73,901 @@ class JSONWithComments(json.JSONDecoder):
         return super().decode(json_string)
 
 
-# Read the JSON file containing configuration for geos
-try:
-    with open(APP_CONFIG_FILE, "r", encoding="utf-8") as file:
-        config = json.loads(file.read(), cls=JSONWithComments)
-        output_path = config["output_path"]
-        source_files = config["source_files"]
-        GEOS = {k: config["target_geos"][k] for k in config["target_geos"].keys() if not k.startswith("inactive")}
-except (OSError, json.JSONDecodeError) as err:
-    print(f"\nERROR: {err}", flush=True)
-    sys.exit(1)
-
-# Add space padded versions to the GEOS dictionary
-for k in GEOS:
-    GEOS[k]["states_pad"] = [f" {s} " for s in GEOS[k]["states"]]
-    GEOS[k]["cities_pad"] = [f" {c} " for c in GEOS[k]["cities"]]
-
-CONFIGURED_GEOS = list(GEOS)
-CHOICES_GEOS = CONFIGURED_GEOS.copy()
-CHOICES_GEOS.append("all")
-VALID_RECORD_TYPES = ("PERSON", "ORGANIZATION")
-
-
-def pure_config(geo, addr_data):
-    """Match address against geo config using explicit city/state/postal_code values."""
-    any_city = len(GEOS[geo].get("cities", [])) == 0
-    any_state = len(GEOS[geo].get("states", [])) == 0
-    any_postal = len(GEOS[geo].get("postal_codes", [])) == 0
-
-    if addr_data["HAS_ADDR_FULL"]:
-        if any_city or any(s in addr_data["ADDR_FULL"] for s in GEOS[geo]["cities_pad"]):
-            if any_state or any(s in addr_data["ADDR_FULL"] for s in GEOS[geo]["states_pad"]):
-                if any_postal or any(f" {s}" in addr_data["ADDR_FULL"] for s in GEOS[geo]["postal_codes"]):
-                    return True
-        return False
+class GeoConfig:  # pylint: disable=too-few-public-methods
+    """Output and index paths, source files and active target geos of a geo_extractor config."""
+
+    def __init__(self, config_data, senzing_config_file=SENZING_CONFIG_FILE):
+        self.output_path = config_data["output_path"]
+        self.index_path = config_data.get("index_path", self.output_path)
+        self.source_files = config_data["source_files"]
+        self.senzing_config_file = senzing_config_file
+        self.geos = {k: v for k, v in config_data["target_geos"].items() if not k.startswith("inactive")}
+
+        # Add space padded versions to the geos
+        for geo_config in self.geos.values():
+            geo_config["states_pad"] = [f" {s} " for s in geo_config["states"]]
+            geo_config["cities_pad"] = [f" {c} " for c in geo_config["cities"]]
+
+
+def load_config(config_file=APP_CONFIG_FILE):
+    """Read the JSON file containing configuration for geos, which may contain comments."""
+    with open(config_file, "r", encoding="utf-8") as f:
+        return GeoConfig(json.loads(f.read(), cls=JSONWithComments))
+
+
+@functools.cache
+def load_parser(senzing_config_file):
+    """Return the record parser for a Senzing config file, loading it once per process."""
+    return json2attribute(senzing_config_file)
+
+
+def normalize_address(addr_data):
+    """Lowercase and trim the address values the geos are matched on, space padding ADDR_FULL."""
+    addr_data["ADDR_FULL"] = f' {addr_data.get("ADDR_FULL", "").replace(",", " ").lower()} '
+    addr_data["HAS_ADDR_FULL"] = bool(addr_data["ADDR_FULL"].strip())
+    addr_data["ADDR_CITY"] = addr_data.get("ADDR_CITY", "").lower().strip()
+    addr_data["ADDR_STATE"] = addr_data.get("ADDR_STATE", "").lower().strip()
+    addr_data["ADDR_POSTAL_CODE"] = addr_data.get("ADDR_POSTAL_CODE", "").lower().strip()
+    addr_data["ADDR_COUNTRY"] = addr_data.get("ADDR_COUNTRY", "").lower().strip()
+    return addr_data
+
+
+class GeoExtractor:  # pylint: disable=too-many-instance-attributes
+    """Streaming extraction of the records of Senzing JSONL lines that are located in the target geos.
+
+    The stages are generators that can be chained or used on their own: iter_records parses the
+    lines that may hold an address, filter_records keeps the person and organization records that
+    pass the name filter and match_geos yields each matching line with the geos it matched. Counts
+    and failed country checks are kept in the stats. Set progress to a function of the row count
+    to have it called every progress_frequency rows, and checkpoint to a function of a byte offset
+    to have it called between records with the offset every line before which has been matched
+    and, for the matching lines, yielded. With a batch size above one match_geos matches the
+    addresses of that many records together. The Senzing config is only loaded once the first
+    line has to be parsed, unless a parser is passed in.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self,
+        config,
+        target_geos=None,
+        alpha_filter="",
+        prefilter=False,
+        extract_names=False,
+        stats=None,
+        json_parser=None,
+        timed=False,
+        debug=False,
+        batch_size=1,
+        country_log_size=DEFAULT_COUNTRY_LOG_SIZE,
+    ):
+        self.config = config
+        self.target_geos = list(target_geos or config.geos)
+        self.alpha_filter = alpha_filter.lower()
+        self.extract_names = bool(self.alpha_filter or extract_names)
+        self.extract_attributes = (
+            ("RECORD_TYPE", "ADDRESS", "NAME") if self.extract_names else ("RECORD_TYPE", "ADDRESS")
+        )
+        self.geo_matcher = GeoMatcher(config.geos, self.target_geos)
+        self.geo_prefilter = GeoPrefilter(config.geos, self.target_geos) if prefilter else None
+        self.stats = new_stats(self.target_geos) if stats is None else stats
+        self.lap = lap_function(self.stats["stage_ns"], timed)
+        self.debug = debug
+        self.batch_size = batch_size
+        self.country_log_size = country_log_size
+        self.progress = None
+        self.progress_frequency = 100_000
+        self.checkpoint = None
+        self._json_parser = json_parser
+
+    @property
+    def json_parser(self):
+        """Return the record parser, loading the Senzing config the first time it is needed."""
+        if self._json_parser is None:
+            self._json_parser = load_parser(self.config.senzing_config_file)
+        return self._json_parser
+
+    def extract(self, lines, offset=0):
+        """Yield each line located in the target geos with the geos it matched, as bytes like iter_records."""
+        return self.match_geos(self.filter_records(self.iter_records(lines, offset)))
+
+    def iter_records(self, lines, offset=0):
+        """Yield the record types, names and normalized addresses of each line that may be in a target geo.
+
+        The lines are bytes, as read from a file opened in binary mode, and str lines are encoded to
+        UTF-8 first. Records also hold their line, as bytes, and its byte offset, counted on from the
+        offset of the first line.
+        """
+        stats = self.stats
+        lap = self.lap
+        for line in lines:
+            if isinstance(line, str):
+                line = line.encode()
+            line_offset = offset
+            offset += len(line)
+            stats["source_cnt"] += 1
+            stats["byte_cnt"] += len(line)
+            if self.progress and stats["source_cnt"] % self.progress_frequency == 0:
+                self.progress(stats["source_cnt"])
+            lap("read")
+
+            if self.debug:
+                print(json.dumps(json.loads(line), indent=4))
+
+            # Continue early if there are no address attributes in the line
+            # if b'"ADDR_' not in line: # oops, what about business_addr...
+            if b"ADDR_" not in line:
+                if self.debug:
+                    print("-> no address!")
+                lap("prefilter")
+                continue
+
+            if self.geo_prefilter and not self.geo_prefilter.may_match(line):
+                if self.debug:
+                    print("-> no target geo values!")
+                stats["prefilter_skip_cnt"] += 1
+                lap("prefilter")
+                continue
+            lap("prefilter")
+
+            record_type_list = []
+            name_list = []
+            addr_list = []
+            for attr_data in self.json_parser.extract(line, self.extract_attributes):
+                if attr_data["ATTRIBUTE"] == "RECORD_TYPE":
+                    record_type_list.append(attr_data["ATTR_VALUE"])
+                elif attr_data["ATTRIBUTE"] == "NAME" and self.extract_names:
+                    name_data = attr_data.get("ATTR_JSON")
+                    if len(name_data.get("NAME_ORG", "")) > 0:
+                        name_list.append(name_data["NAME_ORG"].lower().strip())
+                    elif len(name_data.get("NAME_FULL", "")) > 0:
+                        name_list.append(name_data["NAME_FULL"].lower().strip())
+                    elif len(name_data.get("NAME_LAST", "")) > 0:
+                        name_list.append(name_data["NAME_LAST"].lower().strip())
+
+                elif attr_data["ATTRIBUTE"] == "ADDRESS":
+                    addr_list.append(normalize_address(attr_data["ATTR_JSON"]))
+            lap("parse")
+
+            yield {
+                "line": line,
+                "offset": line_offset,
+                "record_types": record_type_list,
+                "names": name_list,
+                "addresses": addr_list,
+            }
+
+    def iter_indexed_records(self, geo_index):
+        """Yield the records of a geo index in source order, with their offset and length instead of their line."""
+        stats = self.stats
+        lap = self.lap
+        row_cnt = 0
+        for offset, length, record_type_list, name_list, addresses in geo_index.records():
+            row_cnt += 1
+            stats["byte_cnt"] += length
+            if self.progress and row_cnt % self.progress_frequency == 0:
+                self.progress(row_cnt)
+
+            addr_list = []
+            for addr_values in addresses:
+                addr_data = dict(zip(INDEX_ADDR_KEYS, addr_values))
+                addr_data["HAS_ADDR_FULL"] = bool(addr_data["ADDR_FULL"].strip())
+                addr_list.append(addr_data)
+            lap("index")
+
+            yield {
+                "line": None,
+                "offset": offset,
+                "length": length,
+                "record_types": record_type_list,
+                "names": name_list,
+                "addresses": addr_list,
+            }
+
+    def index_records(self, records, geo_index):
+        """Add each record to a geo index as it passes through."""
+        for record in records:
+            geo_index.add(
+                record["offset"],
+                len(record["line"]),
+                record["record_types"],
+                record["names"],
+                [[addr_data[addr_key] for addr_key in INDEX_ADDR_KEYS] for addr_data in record["addresses"]],
+            )
+            self.lap("index")
+            yield record
+
+    def filter_records(self, records):
+        """Yield the records with a valid record type and, when filtering on it, a name starting with alpha_filter."""
+        stats = self.stats
+        lap = self.lap
+        for record in records:
+            if not any(v in VALID_RECORD_TYPES for v in record["record_types"]):
+                if self.debug:
+                    print("-> invalid record_type!")
+                stats["rtype_skip_cnt"] += 1
+                lap("filter")
+                continue
+
+            if self.alpha_filter and not any(n.startswith(self.alpha_filter) for n in record["names"]):
+                if self.debug:
+                    print("-> failed alpha check!")
+                stats["alpha_skip_cnt"] += 1
+                lap("filter")
+                continue
+            lap("filter")
+            yield record
+
+    def match_geos(self, records):
+        """Yield the (line, matched_geos) of each record located in any of the target geos."""
+        if self.batch_size > 1 and not self.debug:
+            yield from self.match_batches(records)
+            return
+        checkpoint = self.checkpoint
+        for record in records:
+            matched_geos = self.match_record(record)
+            if self.debug:
+                input("\npress any key")
+            if matched_geos:
+                yield record["line"], matched_geos
+            if checkpoint:
+                checkpoint(record["offset"] + len(record["line"]))
+
+    def match_batches(self, records):
+        """Yield the (line, matched_geos) of each record located in any target geo, matching batches of records."""
+        checkpoint = self.checkpoint
+        records = iter(records)
+        while batch := list(itertools.islice(records, self.batch_size)):
+            address_results = self.geo_matcher.match_batch(
+                [addr_data for record in batch for addr_data in record["addresses"]]
+            )
+            result_idx = 0
+            for record in batch:
+                address_cnt = len(record["addresses"])
+                matched_geos = self.match_record(record, address_results[result_idx : result_idx + address_cnt])
+                result_idx += address_cnt
+                if matched_geos:
+                    yield record["line"], matched_geos
+            if checkpoint:
+                checkpoint(batch[-1]["offset"] + len(batch[-1]["line"]))
+
+    def match_record(self, record, address_results=None):
+        """Return the target geos a record's addresses are located in, once for each matching address.
+
+        The (matched, rejected) geos of each address can be given, as matched for a batch of records.
+        """
+        if self.debug:
+            matched_geos = self.debug_match(record["addresses"])
+        else:
+            if address_results is None:
+                address_results = map(self.geo_matcher.match, record["addresses"])
+            matched_geos = []
+            for addr_data, (passed_geos, rejected_geos) in zip(record["addresses"], address_results):
+                matched_geos.extend(passed_geos)
+                for target_geo in rejected_geos:
+                    self.log_invalid_country(target_geo, addr_data)
+        target_cnts = self.stats["target_cnts"]
+        for target_geo in matched_geos:
+            target_cnts[target_geo] += 1
+        self.lap("match")
+        return matched_geos
+
+    def confirm_country(self, target_geo, addr_data):
+        """Verify address country matches the target geo's configured countries."""
+        in_country = country_matches(self.config.geos[target_geo], addr_data)
+        if not in_country:
+            self.log_invalid_country(target_geo, addr_data)
+        return in_country
+
+    def log_invalid_country(self, target_geo, addr_data):
+        """Count an address that matched the target geo but failed its country check."""
+        invalid_country_log = self.stats["invalid_country_log"]
+        if target_geo not in invalid_country_log:
+            invalid_country_log[target_geo] = new_summary(self.country_log_size)
+        bad_value = f"{addr_data['ADDR_CITY']}, {addr_data['ADDR_STATE']}, {addr_data['ADDR_COUNTRY']}"
+        add_value(invalid_country_log[target_geo], bad_value)
+
+    def debug_match(self, addr_list):
+        """Run each geo's match function on each address, showing why they pass or fail."""
+        matched_geos = []
+        for target_geo in self.target_geos:
+            geo_config = self.config.geos[target_geo]
+            addr_cnt = 0
+            for addr_data in addr_list:
+                addr_cnt += 1
+                func_name = geo_config["function"]
+                passed = MATCH_FUNCTIONS[func_name](geo_config, addr_data) and self.confirm_country(
+                    target_geo, addr_data
+                )
+                result = "PASSED" if passed else "FAILED"
+                print(f"testing addr {addr_cnt} for {target_geo.upper()} with {func_name}() {result}")
+                if passed:
+                    matched_geos.append(target_geo)
+                else:
+                    print("\tADDR_FULL", addr_data["ADDR_FULL"])
+                    print("\tADDR_CITY", addr_data["ADDR_CITY"], "->", geo_config.get("cities"))
+                    print("\tADDR_STATE", addr_data["ADDR_STATE"], "->", geo_config.get("states"))
+                    print("\tADDR_COUNTRY", addr_data["ADDR_COUNTRY"], "->", geo_config.get("countries"))
+        return matched_geos
+
+
+def read_range(lines, start, end):
+    """Yield the lines, read from an open source file, that start before the end of a byte range, None reading to the end."""
+    if end is None:
+        yield from lines
+        return
+    position = start
+    for line in lines:
+        if position >= end:
+            break
+        position += len(line)
+        yield line
+
+
+def extract_range(  # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-statements
+    source_file,
+    start,
+    end,
+    target_files,
+    options,
+    range_stats,
+    shard_label="",
+    index_file=None,
+    checkpoint_file=None,
+    resume=False,
+):
+    """Extract the lines starting within a byte range of a source file to per geo target files.
+
+    An end of None reads to the end of the file, which is how compressed sources are read. When
+    an index file is given the values matched on are also written to a new index there. With a
+    checkpoint file the progress is saved there periodically, and when resuming the range carries
+    on from its last checkpoint. With --pipeline the source is read ahead and the target files
+    written by background threads.
+    """
+    target_cnts = range_stats["target_cnts"]
+    write_queue = WriteQueue(options.queue_depth) if options.pipeline else None
+    target_writers = {
+        geo: OutputWriter(file_name, options.flush_size, options.compress, write_queue)
+        for geo, file_name in target_files.items()
+    }
+    range_checkpoint = None
+    if checkpoint_file:
+        range_checkpoint = RangeCheckpoint(checkpoint_file, options.checkpoint_secs, range_stats, target_writers)
+        checkpoint_data = load_checkpoint(checkpoint_file) if resume else None
+        if checkpoint_data:
+            merge_stats(range_stats, checkpoint_data["stats"])
+            if checkpoint_data["done"]:
+                # Only renaming the outputs into place may be left to do
+                for geo, target_writer in target_writers.items():
+                    if os.path.exists(target_writer.temp_file_name):
+                        target_writer.resume(*checkpoint_data["outputs"][geo])
+                        target_writer.commit()
+                if write_queue:
+                    write_queue.close()
+                return
+            range_checkpoint.resume(checkpoint_data)
+            start = checkpoint_data["position"]
+            print(f"\nResuming {source_file}{shard_label} after {range_stats['source_cnt']:,} rows")
+    max_geo_len = len(max(target_files, key=len))
+    # An index has to hold every record so it is never built from prefiltered lines
+    extractor = GeoExtractor(
+        options.config,
+        target_files,
+        options.alpha_filter,
+        prefilter=options.prefilter and not index_file,
+        extract_names=bool(index_file),
+        stats=range_stats,
+        timed=options.profile is not None,
+        debug=options.debug,
+        batch_size=options.batch_size,
+        country_log_size=options.country_log_size,
+    )
+    pipeline_queues: dict[str, ChunkReader | WriteQueue] = {}
+
+    def show_progress(row_cnt):
+        elapsed_mins = round((time.time() - options.start_time) / 60, 1)
+        print(
+            f"\n{row_cnt:,} rows read from {source_file}{shard_label} after {elapsed_mins} minutes, "
+            f"{progress_rates(row_cnt, range_stats['byte_cnt'], options)}"
+        )
+        if options.profile is not None:
+            print(f"\t{format_stage_times(range_stats['stage_ns'])}")
+        if pipeline_queues:
+            queue_depths = {
+                queue_name: (pipeline_queue.depth_total, pipeline_queue.depth_samples)
+                for queue_name, pipeline_queue in pipeline_queues.items()
+            }
+            print(f"\t{format_queue_depths(queue_depths, options.queue_depth)}")
+        for geo, target_cnt in target_cnts.items():
+            print(f"\t{geo:<{max_geo_len}} - {target_cnt:,} rows found")
+
+    extractor.progress = show_progress
+    extractor.progress_frequency = options.output_frequency
+    if range_checkpoint:
+        extractor.checkpoint = range_checkpoint.save_when_due
+    lap = extractor.lap
+    geo_index = GeoIndex(index_file) if index_file else None
+    if geo_index:
+        geo_index.create()
+    try:
+        with open_source(source_file, detect_compression(source_file)) as sourcef:
+            if start:
+                seek_source(sourcef, start)
+            lines = sourcef
+            chunk_reader = None
+            if write_queue:
+                chunk_reader = ChunkReader(sourcef, None if end is None else end - start, depth=options.queue_depth)
+                pipeline_queues.update({"read": chunk_reader, "write": write_queue})
+                lines = chunk_reader.lines()
+            try:
+                records = extractor.iter_records(read_range(lines, start, end), start)
+                if geo_index:
+                    records = extractor.index_records(records, geo_index)
+                for line, matched_geos in extractor.match_geos(extractor.filter_records(records)):
+                    for target_geo in matched_geos:
+                        target_writers[target_geo].write(line)
+                    lap("write")
+            finally:
+                if chunk_reader:
+                    chunk_reader.close()
+
+        if range_checkpoint:
+            range_checkpoint.save(end, done=True)
+        for target_writer in target_writers.values():
+            target_writer.commit()
+        lap("write")
+        if geo_index:
+            if start == 0 and end is None:
+                geo_index.commit(source_file, range_stats["source_cnt"])
+            else:
+                geo_index.commit()
+    finally:
+        # Keep whatever was flushed for an unfinished range as .part files
+        for target_writer in target_writers.values():
+            target_writer.close()
+        if write_queue:
+            write_queue.close()
+        if geo_index:
+            geo_index.close()
+        for queue_name, pipeline_queue in pipeline_queues.items():
+            add_queue_depths(range_stats, queue_name, pipeline_queue.depth_total, pipeline_queue.depth_samples)
+
+
+def extract_indexed(source_file, index_file, target_files, options, range_stats):
+    """Extract a source file by matching against its index and reading only the matching lines."""
+    target_cnts = range_stats["target_cnts"]
+    target_writers = {
+        geo: OutputWriter(file_name, options.flush_size, options.compress) for geo, file_name in target_files.items()
+    }
+    max_geo_len = len(max(target_files, key=len))
+    extractor = GeoExtractor(
+        options.config,
+        target_files,
+        options.alpha_filter,
+        stats=range_stats,
+        timed=options.profile is not None,
+        country_log_size=options.country_log_size,
+    )
 
-    if any_city or any(addr_data["ADDR_CITY"] == s for s in GEOS[geo]["cities"]):
-        if any_state or any(addr_data["ADDR_STATE"] == s for s in GEOS[geo]["states"]):
-            if any_postal or any(addr_data["ADDR_POSTAL_CODE"].startswith(s) for s in GEOS[geo]["postal_codes"]):
-                return True
+    def show_progress(row_cnt):
+        elapsed_mins = round((time.time() - options.start_time) / 60, 1)
+        print(
+            f"\n{row_cnt:,} indexed rows read for {source_file} after {elapsed_mins} minutes, "
+            f"{progress_rates(row_cnt, range_stats['byte_cnt'], options)}"
+        )
+        if options.profile is not None:
+            print(f"\t{format_stage_times(range_stats['stage_ns'])}")
+        for geo, target_cnt in target_cnts.items():
+            print(f"\t{geo:<{max_geo_len}} - {target_cnt:,} rows found")
+
+    extractor.progress = show_progress
+    extractor.progress_frequency = options.output_frequency
+    lap = extractor.lap
+    geo_index = GeoIndex(index_file)
+    try:
+        with open_source(source_file, detect_compression(source_file)) as sourcef:
+            # The records come in file order, so compressed sources that cannot seek are read forward
+            position = 0
+            for record in extractor.filter_records(extractor.iter_indexed_records(geo_index)):
+                matched_geos = extractor.match_record(record)
+                if matched_geos:
+                    seek_source(sourcef, record["offset"], position)
+                    line = sourcef.read(record["length"])
+                    position = record["offset"] + len(line)
+                    lap("read")
+                    for target_geo in matched_geos:
+                        target_writers[target_geo].write(line)
+                    lap("write")
+
+        range_stats["source_cnt"] = geo_index.line_cnt()
+        for target_writer in target_writers.values():
+            target_writer.commit()
+        lap("write")
+    finally:
+        for target_writer in target_writers.values():
+            target_writer.close()
+
+
+def extract_shard(shard_args):
+    """Pool task that extracts one shard and returns its stats."""
+    (
+        source_code,
+        source_file,
+        shard_idx,
+        shard_cnt,
+        start,
+        end,
+        target_files,
+        options,
+        index_file,
+        use_index,
+        checkpoint_file,
+        resume,
+    ) = shard_args
+    shard_files = {geo: f"{file_name}.shard{shard_idx}" for geo, file_name in target_files.items()}
+    range_stats = new_stats(target_files)
+    range_stats.update({"source_code": source_code, "shard_idx": shard_idx, "shard_files": shard_files})
+    shard_label = f" [shard {shard_idx + 1}/{shard_cnt}]" if shard_cnt > 1 else ""
+    profiler = cProfile.Profile() if options.profile else None
+    if profiler:
+        profiler.enable()
+    try:
+        if use_index:
+            extract_indexed(source_file, index_file, shard_files, options, range_stats)
+        else:
+            if index_file and shard_cnt > 1:
+                index_file = f"{index_file}.shard{shard_idx}"
+            extract_range(
+                source_file,
+                start,
+                end,
+                shard_files,
+                options,
+                range_stats,
+                shard_label,
+                index_file,
+                checkpoint_file and f"{checkpoint_file}.shard{shard_idx}",
+                resume,
+            )
+    except (OSError, ValueError) as err:
+        range_stats["error"] = str(err)
+    if profiler:
+        profiler.disable()
+        range_stats["profile_file"] = f"{options.profile}.{source_code}.shard{shard_idx}"
+        profiler.dump_stats(range_stats["profile_file"])
+    return range_stats
+
+
+def extract_sources(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    source_files, target_files, options, source_stats, source_status, index_files, checkpoint_files
+):
+    """Extract each source, scheduling shards of all of them across a process pool when using multiple workers.
+
+    Sources with a current index file are extracted from it, others build their index as they are read.
+    Sources with a checkpoint file save their progress there and remove it once complete.
+    """
+    indexed_sources = set()
+    for source_code, index_file in index_files.items():
+        if GeoIndex(index_file).is_current(source_files[source_code]):
+            indexed_sources.add(source_code)
+
+    if options.workers == 1:
+        for source_code, source_file in source_files.items():
+            try:
+                source_status[source_code] = "Processing"
+                if source_code in indexed_sources:
+                    print(f"\nProcessing {source_file} from {index_files[source_code]}\n")
+                    extract_indexed(
+                        source_file,
+                        index_files[source_code],
+                        target_files[source_code],
+                        options,
+                        source_stats[source_code],
+                    )
+                else:
+                    checkpoint_file = checkpoint_files.get(source_code)
+                    if checkpoint_file:
+                        source_checkpoint(checkpoint_file, source_file, target_files[source_code], [[0, None]], options)
+                    print(f"\nProcessing {source_file}\n")
+                    extract_range(
+                        source_file,
+                        0,
+                        None,
+                        target_files[source_code],
+                        options,
+                        source_stats[source_code],
+                        index_file=index_files.get(source_code),
+                        checkpoint_file=checkpoint_file and f"{checkpoint_file}.shard0",
+                        resume=options.resume,
+                    )
+                    if checkpoint_file:
+                        remove_checkpoints(checkpoint_file)
+                source_status[source_code] = "Complete"
+            except (OSError, ValueError) as err:
+                source_status[source_code] = "Errored out!"
+                print(f"\nERROR: {err}", flush=True)
+        return
+
+    extract_shards(
+        source_files,
+        target_files,
+        options,
+        source_stats,
+        source_status,
+        index_files,
+        checkpoint_files,
+        indexed_sources,
+        extract_shard,
+    )
 
-    return False
 
+def build_arg_parser(config):
+    """Return the command line parser, offering the configured geos as target geos."""
+    choices_geos = [*config.geos, "all"]
 
-def city_or_country(geo, addr_data):
-    """Used for geos where the city is also a country and the geo might be in either addr_city or addr_country"""
-    if addr_data["HAS_ADDR_FULL"]:
-        return any(c in addr_data["ADDR_FULL"] for c in GEOS[geo]["cities_pad"])
-    return any(s in addr_data["ADDR_CITY"] for s in GEOS[geo]["cities"]) or any(
-        c in addr_data["ADDR_COUNTRY"] for c in GEOS[geo]["countries"]
+    arg_parser = argparse.ArgumentParser(
+        allow_abbrev=False,
+        description="Utility to extract geo located records from JSONL files",
+        formatter_class=argparse.RawTextHelpFormatter,
     )
+    arg_parser.add_argument(
+        "source_file", nargs="?", help="input file to extract JSONL records from. Use all to process all files."
+    )
+    arg_parser.add_argument(
+        "target_geos",
+        choices=choices_geos,
+        metavar="target_geos",
+        nargs="+",
+        help=f"one or more (space separated) target geos. Use all to process all geos. Available geos:\n{', '.join(choices_geos)}",
+    )
+    arg_parser.add_argument(
+        "-o",
+        default=100_000,
+        dest="output_frequency",
+        metavar="int",
+        type=int,
+        help="change stats output frequency, default = %(default)s",
+    )
+    arg_parser.add_argument(
+        "-f",
+        "--flush-size",
+        default=DEFAULT_FLUSH_SIZE,
+        dest="flush_size",
+        metavar="int",
+        type=int,
+        help="bytes buffered per output file before appending to disk, default = %(default)s",
+    )
+    arg_parser.add_argument(
+        "-w",
+        "--workers",
+        default=1,
+        dest="workers",
+        metavar="int",
+        type=int,
+        help="number of processes to extract the source files with, default = %(default)s",
+    )
+    arg_parser.add_argument(
+        "--ordered",
+        dest="ordered",
+        action="store_true",
+        default=False,
+        help="keep output lines in source file order when using multiple workers",
+    )
+    arg_parser.add_argument(
+        "-z",
+        "--compress",
+        choices=list(COMPRESSION_EXTENSIONS),
+        default=None,
+        dest="compress",
+        help="compress the output files with gz, bz2 or zst (zst requires the zstandard package)",
+    )
+    arg_parser.add_argument(
+        "--prefilter",
+        dest="prefilter",
+        action="store_true",
+        default=False,
+        help="skip lines containing none of the target geos' values before parsing them",
+    )
+    arg_parser.add_argument(
+        "--index",
+        dest="index",
+        action="store_true",
+        default=False,
+        help="keep a geo index of each source in index_path and extract from it while the source is unchanged",
+    )
+    arg_parser.add_argument(
+        "--pipeline",
+        dest="pipeline",
+        action="store_true",
+        default=False,
+        help="read ahead and write in background threads, overlapping them with parsing and matching",
+    )
+    arg_parser.add_argument(
+        "--queue-depth",
+        default=DEFAULT_QUEUE_DEPTH,
+        dest="queue_depth",
+        metavar="int",
+        type=int,
+        help="chunks read ahead and flushes waiting to be written with --pipeline, default = %(default)s",
+    )
+    arg_parser.add_argument(
+        "--batch-size",
+        default=DEFAULT_BATCH_SIZE,
+        dest="batch_size",
+        metavar="int",
+        type=int,
+        help="records whose addresses are matched together, 1 to match each record on its own, default = %(default)s",
+    )
+    arg_parser.add_argument(
+        "--country-log",
+        dest="country_log",
+        metavar="file",
+        default=None,
+        help="JSON file for the country check failures of all sources, default = SOURCE.invalid_countries.json each",
+    )
+    arg_parser.add_argument(
+        "--country-log-size",
+        default=DEFAULT_COUNTRY_LOG_SIZE,
+        dest="country_log_size",
+        metavar="int",
+        type=int,
+        help="most frequent addresses failing the country check to keep counts for per geo, default = %(default)s",
+    )
+    arg_parser.add_argument(
+        "--checkpoint-secs",
+        default=60,
+        dest="checkpoint_secs",
+        metavar="float",
+        type=float,
+        help="seconds between checkpoints of each source's progress in output_path, 0 for none, default = %(default)s",
+    )
+    arg_parser.add_argument(
+        "--resume",
+        dest="resume",
+        action="store_true",
+        default=False,
+        help="carry on from the checkpoints an interrupted run left instead of starting over",
+    )
+    arg_parser.add_argument(
+        "--profile",
+        dest="profile",
+        metavar="pstats_file",
+        nargs="?",
+        const="",
+        default=None,
+        help="show the time spent in each stage, and write cProfile stats to pstats_file if given",
+    )
+    arg_parser.add_argument(
+        "--stats-json", dest="stats_json", metavar="file", default=None, help="write the run metrics to a JSON file"
+    )
+    arg_parser.add_argument("-a", "--alpha", dest="alpha_filter", default="", help="optional name startswith filter")
+    arg_parser.add_argument("-D", "--debug", dest="debug", action="store_true", default=False, help="run in debug mode")
+    return arg_parser
+
+
+def parse_args(config):
+    """Parse and check the command line, resolving target geo all to the configured geos."""
+    arg_parser = build_arg_parser(config)
+    cli_args = arg_parser.parse_args()
+    if len(cli_args.target_geos) == 1 and "all" in cli_args.target_geos:
+        cli_args.target_geos = list(config.geos)
+
+    if cli_args.workers < 1:
+        arg_parser.error("--workers must be at least 1")
+    if cli_args.debug and cli_args.workers > 1:
+        arg_parser.error("--debug cannot be used with multiple workers")
+    if cli_args.debug and cli_args.index:
+        arg_parser.error("--debug cannot be used with --index")
+    if cli_args.queue_depth < 1:
+        arg_parser.error("--queue-depth must be at least 1")
+    if cli_args.batch_size < 1:
+        arg_parser.error("--batch-size must be at least 1")
+    if cli_args.country_log_size < 1:
+        arg_parser.error("--country-log-size must be at least 1")
+    if cli_args.checkpoint_secs < 0:
+        arg_parser.error("--checkpoint-secs cannot be negative")
+    if cli_args.resume and (cli_args.index or not cli_args.checkpoint_secs):
+        arg_parser.error("--resume cannot be used with --index or --checkpoint-secs 0")
+    if cli_args.compress == "zst" and zstandard is None:
+        arg_parser.error("zst compression requires the zstandard package, pip install zstandard")
+
+    if cli_args.prefilter:
+        try:
+            GeoPrefilter(config.geos, cli_args.target_geos)
+        except ValueError as err:
+            print(f"\nWARNING: prefilter disabled, {err}", flush=True)
+            cli_args.prefilter = False
+    return cli_args
+
+
+def output_files(config, selected_files, options, alpha_extension):
+    """Return the target files, index files and checkpoint files of each selected source."""
+    file_extension = ".jsonl" + COMPRESSION_EXTENSIONS.get(options.compress, "")
+
+    target_files = {
+        source_code: {
+            tg: f"{config.output_path}/{source_code}-{tg}{alpha_extension}{file_extension}"
+            for tg in options.target_geos
+        }
+        for source_code in selected_files
+    }
+    index_files = {}
+    if options.index:
+        index_files = {source_code: f"{config.index_path}/{source_code}.geoidx" for source_code in selected_files}
+    # Indexes are built from whole runs, so index runs are not checkpointed. Runs with other target
+    # geos get their own checkpoints
+    checkpoint_files = {}
+    if options.checkpoint_secs and not options.index:
+        geos_hash = hashlib.sha256(",".join(sorted(options.target_geos)).encode()).hexdigest()[:12]
+        checkpoint_files = {
+            source_code: f"{config.output_path}/{source_code}{alpha_extension}.{geos_hash}.checkpoint"
+            for source_code in selected_files
+        }
+    return target_files, index_files, checkpoint_files
 
 
-def confirm_country(target_geo, addr_data):
-    """Verify address country matches the target geo's configured countries."""
-    if addr_data["ADDR_COUNTRY"]:
-        in_country = any(addr_data["ADDR_COUNTRY"] == c for c in GEOS[target_geo]["countries"])
-    elif addr_data["HAS_ADDR_FULL"]:
-        in_country = any(f" {c} " in addr_data["ADDR_FULL"] for c in GEOS[target_geo]["countries"])
-    else:
-        in_country = not addr_data["ADDR_COUNTRY"]
-    if not in_country:
-        if target_geo not in invalid_country_log:
-            invalid_country_log[target_geo] = {}
-        bad_value = f"{addr_data['ADDR_CITY']}, {addr_data['ADDR_STATE']}, {addr_data['ADDR_COUNTRY']}"
-        if bad_value not in invalid_country_log[target_geo]:
-            invalid_country_log[target_geo][bad_value] = 1
-        else:
-            invalid_country_log[target_geo][bad_value] += 1
-    return in_country
-
-
-arg_parser = argparse.ArgumentParser(
-    allow_abbrev=False,
-    description="Utility to extract geo located records from JSONL files",
-    formatter_class=argparse.RawTextHelpFormatter,
-)
-arg_parser.add_argument(
-    "source_file", nargs="?", help="input file to extract JSONL records from. Use all to process all files."
-)
-arg_parser.add_argument(
-    "target_geos",
-    choices=CHOICES_GEOS,
-    metavar="target_geos",
-    nargs="+",
-    help=f"one or more (space separated) target geos. Use all to process all geos. Available geos:\n{', '.join(CHOICES_GEOS)}",
-)
-arg_parser.add_argument(
-    "-o",
-    default=100_000,
-    dest="output_frequency",
-    metavar="int",
-    nargs=1,
-    type=int,
-    help="change stats output frequency, default = %(default)s",
-)
-arg_parser.add_argument("-a", "--alpha", dest="alpha_filter", default="", help="optional name startswith filter")
-arg_parser.add_argument("-D", "--debug", dest="debug", action="store_true", default=False, help="run in debug mode")
-
-cli_args = arg_parser.parse_args()
-source_file = cli_args.source_file
-target_geos = cli_args.target_geos
-if len(cli_args.target_geos) == 1 and "all" in cli_args.target_geos:
-    target_geos = CONFIGURED_GEOS
-MAX_GEO_LEN = len(max(target_geos, key=len))
-target_stats: dict[str, dict[str, Any]] = {}
-invalid_country_log: dict[str, dict[str, int]] = {}
-
-if source_file.lower() != "all":
-    if source_file not in source_files:
-        print(f"\n{source_file} not configured, configured files:\n")
-        for sf in source_files:
-            print(f"\t{sf}")
+def main():
+    """Parse the command line and extract the requested geos from the requested sources."""
+    try:
+        config = load_config()
+    except (OSError, json.JSONDecodeError) as err:
+        print(f"\nERROR: {err}", flush=True)
         sys.exit(1)
-    source_files = {source_file: source_files[source_file]}
-
-# print("sources", source_files.keys)
-# print("geos", target_geos)
-
-cli_args.alpha_filter = cli_args.alpha_filter.lower()
-alpha_extension = f"-{cli_args.alpha_filter.upper()}" if cli_args.alpha_filter else ""
-
-for source_code, source_file in source_files.items():
-    target_stats[source_code] = {}
-    for tg in target_geos:
-        target_stats[source_code][tg] = {
-            "target_file_name": f"{output_path}/{source_code}-{tg}{alpha_extension}.jsonl",
-            "target_prefix": source_code,
-            "target_cnt": 0,
-            "target_lines": [],
-        }
-proc_status = "Complete"
-proc_start_time = time.time()
-for source_code, source_file in source_files.items():
+    cli_args = parse_args(config)
+    source_file = cli_args.source_file
+    target_geos = cli_args.target_geos
+
+    selected_files = config.source_files
+    if source_file.lower() != "all":
+        if source_file not in config.source_files:
+            print(f"\n{source_file} not configured, configured files:\n")
+            for sf in config.source_files:
+                print(f"\t{sf}")
+            sys.exit(1)
+        selected_files = {source_file: config.source_files[source_file]}
+
+    # print("sources", selected_files.keys)
+    # print("geos", target_geos)
+
+    cli_args.alpha_filter = cli_args.alpha_filter.lower()
+    alpha_extension = f"-{cli_args.alpha_filter.upper()}" if cli_args.alpha_filter else ""
+    target_files, index_files, checkpoint_files = output_files(config, selected_files, cli_args, alpha_extension)
+    source_stats = {source_code: new_stats(target_geos) for source_code in selected_files}
+    source_status = {source_code: "Pending" for source_code in selected_files}
+    proc_status = "Complete"
+    cli_args.config = config
+    cli_args.start_time = time.time()
+    profiler = cProfile.Profile() if cli_args.profile else None
+    if profiler:
+        profiler.enable()
     try:
-        with open(source_file, "r", encoding="utf-8") as sourcef:
-            print(f"\nProcessing {source_file}\n")
-
-            source_cnt = 0
-            rtype_skip_cnt = 0
-            alpha_skip_cnt = 0
-            for line in sourcef:
-                source_cnt += 1
-                if source_cnt % cli_args.output_frequency == 0:
-                    elapsed_mins = round((time.time() - proc_start_time) / 60, 1)
-                    print(f"\n{source_cnt:,} rows read from {source_file} after {elapsed_mins} minutes")
-                    for geo, stats in target_stats[source_code].items():
-                        print(f"\t{geo:<{MAX_GEO_LEN}} - {stats['target_cnt']:,} rows found")
-
-                if cli_args.debug:
-                    print(json.dumps(json.loads(line), indent=4))
-
-                # Continue early if there are no address attributes in the line
-                # if '"ADDR_' not in line: # oops, what about business_addr...
-                if "ADDR_" not in line:
-                    if cli_args.debug:
-                        print("-> no address!")
-                    continue
-
-                record_type_list = []
-                name_list = []
-                addr_list = []
-                for attr_data in json_parser.parse(line):
-                    if attr_data["ATTRIBUTE"] == "RECORD_TYPE":
-                        record_type_list.append(attr_data["ATTR_VALUE"])
-                    elif attr_data["ATTRIBUTE"] == "NAME" and cli_args.alpha_filter:
-                        name_data = attr_data.get("ATTR_JSON")
-                        if len(name_data.get("NAME_ORG", "")) > 0:
-                            name_list.append(name_data["NAME_ORG"].lower().strip())
-                        elif len(name_data.get("NAME_FULL", "")) > 0:
-                            name_list.append(name_data["NAME_FULL"].lower().strip())
-                        elif len(name_data.get("NAME_LAST", "")) > 0:
-                            name_list.append(name_data["NAME_LAST"].lower().strip())
-
-                    elif attr_data["ATTRIBUTE"] == "ADDRESS":
-                        addr_data = attr_data.get("ATTR_JSON")
-                        addr_data["ADDR_FULL"] = f' {addr_data.get("ADDR_FULL", "").replace(",", " ").lower()} '
-                        addr_data["HAS_ADDR_FULL"] = bool(addr_data["ADDR_FULL"].strip())
-                        addr_data["ADDR_CITY"] = addr_data.get("ADDR_CITY", "").lower().strip()
-                        addr_data["ADDR_STATE"] = addr_data.get("ADDR_STATE", "").lower().strip()
-                        addr_data["ADDR_POSTAL_CODE"] = addr_data.get("ADDR_POSTAL_CODE", "").lower().strip()
-                        addr_data["ADDR_COUNTRY"] = addr_data.get("ADDR_COUNTRY", "").lower().strip()
-                        addr_list.append(addr_data)
-
-                if not any(v in VALID_RECORD_TYPES for v in record_type_list):
-                    if cli_args.debug:
-                        print("-> invalid record_type!")
-                    rtype_skip_cnt += 1
-                    continue
-
-                if cli_args.alpha_filter and not any(n.startswith(cli_args.alpha_filter) for n in name_list):
-                    if cli_args.debug:
-                        print("-> failed alpha check!")
-                    alpha_skip_cnt += 1
-                    continue
-
-                for target_geo in target_geos:
-                    addr_cnt = 0
-                    for addr_data in addr_list:
-                        addr_cnt += 1
-                        passed = globals()[GEOS[target_geo]["function"]](target_geo, addr_data) and confirm_country(
-                            target_geo, addr_data
-                        )
-                        if cli_args.debug:
-                            func_name = GEOS[target_geo]["function"]
-                            result = "PASSED" if passed else "FAILED"
-                            print(f"testing addr {addr_cnt} for {target_geo.upper()} with {func_name}() {result}")
-                        if passed:
-                            target_stats[source_code][target_geo]["target_cnt"] += 1
-                            target_stats[source_code][target_geo]["target_lines"].append(line)
-                        elif cli_args.debug:
-                            print("\tADDR_FULL", addr_data["ADDR_FULL"])
-                            print("\tADDR_CITY", addr_data["ADDR_CITY"], "->", GEOS[target_geo].get("cities"))
-                            print("\tADDR_STATE", addr_data["ADDR_STATE"], "->", GEOS[target_geo].get("states"))
-                            print("\tADDR_COUNTRY", addr_data["ADDR_COUNTRY"], "->", GEOS[target_geo].get("countries"))
-
-                if cli_args.debug:
-                    input("\npress any key")
-
+        extract_sources(
+            selected_files, target_files, cli_args, source_stats, source_status, index_files, checkpoint_files
+        )
     except KeyboardInterrupt:
         proc_status = "Interrupted"
         print("Keyboard interrupt!")
-        break
-    except OSError as err:  # Exception as err:
-        proc_status = "Errored out!"
-        print(f"\nERROR: {err}", flush=True)
-        break
-
-print(f"\n\nProcessing {proc_status}")
-print("-" * 19)
-for f in source_files:
-    print(f"\n{f} - {source_cnt:,} rows read")
-    for geo, stats in target_stats[f].items():
-        print(f"\t{geo:<{MAX_GEO_LEN}} - {stats['target_cnt']:,} rows found")
-        output_filename = stats["target_file_name"]
-        target_lines = stats["target_lines"]
-        if len(target_lines) > 0:
-            with open(output_filename, "w", encoding="utf-8") as targetf:
-                # print(f"writing {output_filename} ...")
-                targetf.writelines(target_lines)
-
-
-if invalid_country_log:
-    print("\nInvalid country log ...")
-    print(json.dumps(invalid_country_log, indent=4))
-    print()
+        for source_code, status in source_status.items():
+            if status == "Processing":
+                source_status[source_code] = "Interrupted"
+    if profiler:
+        profiler.disable()
+    elapsed_secs = time.time() - cli_args.start_time
+    if proc_status == "Complete" and any(status != "Complete" for status in source_status.values()):
+        proc_status = "Completed with errors"
+
+    print(f"\n\nProcessing {proc_status}")
+    print("-" * 19)
+    print_summary(source_stats, source_status, target_files, checkpoint_files, cli_args)
+
+    invalid_country_log = write_country_logs(source_stats, cli_args, alpha_extension)
+
+    if cli_args.profile is not None:
+        print_profile(source_stats, invalid_country_log, elapsed_secs, cli_args, profiler)
+    if cli_args.stats_json:
+        write_stats_json(
+            cli_args.stats_json, source_stats, source_status, invalid_country_log, proc_status, elapsed_secs, cli_args
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Sidecar index of the values geo matching needs from each record of a source file."""
+
+import os
+import sqlite3
+from contextlib import closing
+
+import orjson
+
+INDEX_VERSION = "1"
+INSERT_BATCH_SIZE = 10_000
+
+
+def source_signature(source_file):
+    """Return the path, size and modification time an index is valid for."""
+    source_stat = os.stat(source_file)
+    return {
+        "source_path": os.path.abspath(source_file),
+        "source_size": str(source_stat.st_size),
+        "source_mtime": str(source_stat.st_mtime_ns),
+        "index_version": INDEX_VERSION,
+    }
+
+
+class GeoIndex:
+    """SQLite file holding the byte offset, record types, names and normalized addresses of each record.
+
+    The index is written to a .part file while a source is extracted and renamed into place once
+    the whole source has been read, so a later run can evaluate geo rules against it and read only
+    the matching lines from the source.
+    """
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.temp_file_name = index_file + ".part"
+        self.connection: sqlite3.Connection | None = None
+        self.pending_rows: list[tuple[int, int, bytes]] = []
+
+    def is_current(self, source_file):
+        """Return True if the index exists and was built from the source file as it is now."""
+        if not os.path.exists(self.index_file):
+            return False
+        try:
+            with closing(sqlite3.connect(self.index_file)) as connection:
+                index_meta = dict(connection.execute("SELECT key, value FROM meta"))
+        except sqlite3.Error:
+            return False
+        return all(index_meta.get(key) == value for key, value in source_signature(source_file).items())
+
+    def line_cnt(self):
+        """Return the number of lines in the indexed source file."""
+        with closing(sqlite3.connect(self.index_file)) as connection:
+            (line_cnt,) = connection.execute("SELECT value FROM meta WHERE key = 'line_cnt'").fetchone()
+        return int(line_cnt)
+
+    def records(self):
+        """Yield the (offset, length, record_types, names, addresses) of each indexed record in file order."""
+        with closing(sqlite3.connect(self.index_file)) as connection:
+            for offset, length, record_data in connection.execute(
+                "SELECT offset, length, record_data FROM records ORDER BY offset"
+            ):
+                record_types, names, addresses = orjson.loads(record_data)
+                yield offset, length, record_types, names, addresses
+
+    def create(self):
+        """Start writing a new index to the temporary file."""
+        if os.path.exists(self.temp_file_name):
+            os.remove(self.temp_file_name)
+        self.connection = sqlite3.connect(self.temp_file_name)
+        self.connection.execute("PRAGMA journal_mode = OFF")
+        self.connection.execute("PRAGMA synchronous = OFF")
+        self.connection.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.execute("CREATE TABLE records (offset INTEGER PRIMARY KEY, length INTEGER, record_data BLOB)")
+
+    def add(self, offset, length, record_types, names, addresses):
+        """Add a record's normalized values, addresses being (full, city, state, postal code, country) lists."""
+        self.pending_rows.append((offset, length, orjson.dumps([record_types, names, addresses])))
+        if len(self.pending_rows) >= INSERT_BATCH_SIZE:
+            self.flush()
+
+    def add_index(self, index_file):
+        """Copy the records of another index, such as one written for a shard of the source."""
+        assert self.connection
+        self.flush()
+        self.connection.execute("ATTACH DATABASE ? AS shard", (index_file,))
+        self.connection.execute("INSERT INTO records SELECT * FROM shard.records")
+        self.connection.commit()
+        self.connection.execute("DETACH DATABASE shard")
+
+    def flush(self):
+        """Insert the pending records."""
+        assert self.connection
+        if self.pending_rows:
+            self.connection.executemany("INSERT INTO records VALUES (?, ?, ?)", self.pending_rows)
+            self.pending_rows = []
+
+    def close(self):
+        """Close the temporary file without publishing it."""
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    def commit(self, source_file=None, line_cnt=0):
+        """Record what the index was built from and rename it into place.
+
+        Shard indexes are committed without a source file since only their merged index is matched
+        against the source.
+        """
+        assert self.connection
+        self.flush()
+        if source_file:
+            index_meta = source_signature(source_file)
+            index_meta["line_cnt"] = str(line_cnt)
+            self.connection.executemany("INSERT INTO meta VALUES (?, ?)", index_meta.items())
+        self.connection.commit()
+        self.close()
+        os.replace(self.temp_file_name, self.index_file)
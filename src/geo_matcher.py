@@ -0,0 +1,352 @@
+"""Geo match functions and the compiled matcher that evaluates every target geo against an address in one pass."""
+
+import re
+from typing import Callable
+
+MATCH_FUNCTIONS: dict[str, Callable[[dict, dict], bool]] = {}
+COMPILED_FUNCTIONS = ("pure_config", "city_or_country")
+PREFILTER_ROLES = ("cities", "states", "countries", "postal_codes")
+NO_MATCH: tuple[tuple[str, ...], tuple[str, ...]] = ((), ())
+
+
+def register_match_function(match_function):
+    """Register a geo match function under its name, for geos to select with their "function" setting."""
+    MATCH_FUNCTIONS[match_function.__name__] = match_function
+    return match_function
+
+
+@register_match_function
+def pure_config(geo_config, addr_data):
+    """Match address against geo config using explicit city/state/postal_code values."""
+    any_city = len(geo_config.get("cities", [])) == 0
+    any_state = len(geo_config.get("states", [])) == 0
+    any_postal = len(geo_config.get("postal_codes", [])) == 0
+
+    if addr_data["HAS_ADDR_FULL"]:
+        if any_city or any(s in addr_data["ADDR_FULL"] for s in geo_config["cities_pad"]):
+            if any_state or any(s in addr_data["ADDR_FULL"] for s in geo_config["states_pad"]):
+                if any_postal or any(f" {s}" in addr_data["ADDR_FULL"] for s in geo_config["postal_codes"]):
+                    return True
+        return False
+
+    if any_city or any(addr_data["ADDR_CITY"] == s for s in geo_config["cities"]):
+        if any_state or any(addr_data["ADDR_STATE"] == s for s in geo_config["states"]):
+            if any_postal or any(addr_data["ADDR_POSTAL_CODE"].startswith(s) for s in geo_config["postal_codes"]):
+                return True
+
+    return False
+
+
+@register_match_function
+def city_or_country(geo_config, addr_data):
+    """Used for geos where the city is also a country and the geo might be in either addr_city or addr_country"""
+    if addr_data["HAS_ADDR_FULL"]:
+        return any(c in addr_data["ADDR_FULL"] for c in geo_config["cities_pad"])
+    return any(s in addr_data["ADDR_CITY"] for s in geo_config["cities"]) or any(
+        c in addr_data["ADDR_COUNTRY"] for c in geo_config["countries"]
+    )
+
+
+def country_matches(geo_config, addr_data):
+    """Return True if the address country matches the geo's configured countries."""
+    if addr_data["ADDR_COUNTRY"]:
+        return any(addr_data["ADDR_COUNTRY"] == c for c in geo_config["countries"])
+    if addr_data["HAS_ADDR_FULL"]:
+        return any(f" {c} " in addr_data["ADDR_FULL"] for c in geo_config["countries"])
+    return True
+
+
+class GeoMatcher:
+    """Index of the target geo strings giving the same results as the per geo match functions.
+
+    Padded city/state/country strings that are searched for in ADDR_FULL are indexed as phrases
+    of space separated tokens, so a single walk over the tokens of an ADDR_FULL finds every
+    configured string it contains. Exact ADDR_CITY/ADDR_STATE/ADDR_COUNTRY comparisons become
+    dictionary lookups. Geos using other registered match functions are evaluated by calling them.
+    """
+
+    def __init__(self, geos, target_geos):
+        self.geo_rules = []
+        self.function_rules = []
+        self.phrase_lookup: dict[str, set[tuple[str, str]]] = {}
+        self.phrase_lengths: dict[str, set[int]] = {}
+        self.exact_lookup: dict[str, dict[str, set[str]]] = {"cities": {}, "states": {}, "countries": {}}
+        self.contains_lookup: dict[str, dict[str, set[str]]] = {"cities": {}, "countries": {}}
+        for geo in target_geos:
+            geo_config = geos[geo]
+            function = geo_config["function"]
+            if function not in MATCH_FUNCTIONS:
+                raise ValueError(f"unknown match function {function} for geo {geo}")
+            if function not in COMPILED_FUNCTIONS:
+                self.function_rules.append((geo, MATCH_FUNCTIONS[function], geo_config))
+                continue
+            self.geo_rules.append(
+                (
+                    geo,
+                    function,
+                    len(geo_config.get("cities", [])) == 0,
+                    len(geo_config.get("states", [])) == 0,
+                    geo_config.get("postal_codes", []),
+                )
+            )
+            for role in ("cities", "states", "countries"):
+                for value in geo_config.get(role, []):
+                    self.add_phrase(value, geo, role)
+                    self.exact_lookup[role].setdefault(value, set()).add(geo)
+            if function == "city_or_country":
+                for role in ("cities", "countries"):
+                    for value in geo_config.get(role, []):
+                        self.contains_lookup[role].setdefault(value, set()).add(geo)
+
+    def add_phrase(self, value, geo, role):
+        """Index a configured value as the phrase that must appear space padded in ADDR_FULL."""
+        tokens = value.split(" ")
+        self.phrase_lookup.setdefault(value, set()).add((geo, role))
+        self.phrase_lengths.setdefault(tokens[0], set()).add(len(tokens))
+
+    def full_hits(self, addr_full):
+        """Return the (geo, role) pairs whose value appears space padded in a padded ADDR_FULL."""
+        hits: set[tuple[str, str]] = set()
+        tokens = addr_full.split(" ")
+        last_idx = len(tokens) - 1
+        # Only tokens with a space on both sides can start or end a match
+        for i in range(1, last_idx):
+            phrase_lengths = self.phrase_lengths.get(tokens[i])
+            if not phrase_lengths:
+                continue
+            for phrase_len in phrase_lengths:
+                if i + phrase_len > last_idx:
+                    continue
+                phrase = tokens[i] if phrase_len == 1 else " ".join(tokens[i : i + phrase_len])
+                if phrase in self.phrase_lookup:
+                    hits.update(self.phrase_lookup[phrase])
+        return hits
+
+    def contains_hits(self, role, value):
+        """Return the geos with a configured value contained in an address value."""
+        if not value:
+            return set(self.contains_lookup[role].get("", ()))
+        hits: set[str] = set()
+        for configured_value, geos in self.contains_lookup[role].items():
+            if configured_value in value:
+                hits.update(geos)
+        return hits
+
+    def match(self, addr_data):
+        """Return the geos an address matches and the geos it matched but failed the country check for."""
+        matched_geos = []
+        rejected_geos = []
+        if addr_data["HAS_ADDR_FULL"]:
+            addr_full = addr_data["ADDR_FULL"]
+            hits = self.full_hits(addr_full)
+            for geo, function, any_city, any_state, postal_codes in self.geo_rules:
+                if function == "pure_config":
+                    passed = (
+                        (any_city or (geo, "cities") in hits)
+                        and (any_state or (geo, "states") in hits)
+                        and (not postal_codes or any(f" {s}" in addr_full for s in postal_codes))
+                    )
+                else:
+                    passed = (geo, "cities") in hits
+                if not passed:
+                    continue
+                if addr_data["ADDR_COUNTRY"]:
+                    in_country = geo in self.exact_lookup["countries"].get(addr_data["ADDR_COUNTRY"], ())
+                else:
+                    in_country = (geo, "countries") in hits
+                (matched_geos if in_country else rejected_geos).append(geo)
+            self.match_functions(addr_data, matched_geos, rejected_geos)
+            return matched_geos, rejected_geos
+
+        city_geos = self.exact_lookup["cities"].get(addr_data["ADDR_CITY"], ())
+        state_geos = self.exact_lookup["states"].get(addr_data["ADDR_STATE"], ())
+        country_geos = self.exact_lookup["countries"].get(addr_data["ADDR_COUNTRY"], ())
+        contains_geos = None
+        for geo, function, any_city, any_state, postal_codes in self.geo_rules:
+            if function == "pure_config":
+                passed = (
+                    (any_city or geo in city_geos)
+                    and (any_state or geo in state_geos)
+                    and (not postal_codes or any(addr_data["ADDR_POSTAL_CODE"].startswith(s) for s in postal_codes))
+                )
+            else:
+                if contains_geos is None:
+                    contains_geos = self.contains_hits("cities", addr_data["ADDR_CITY"]) | self.contains_hits(
+                        "countries", addr_data["ADDR_COUNTRY"]
+                    )
+                passed = geo in contains_geos
+            if not passed:
+                continue
+            in_country = not addr_data["ADDR_COUNTRY"] or geo in country_geos
+            (matched_geos if in_country else rejected_geos).append(geo)
+        self.match_functions(addr_data, matched_geos, rejected_geos)
+        return matched_geos, rejected_geos
+
+    def match_batch(self, addresses):
+        """Return the (matched geos, rejected geos) of each of a list of addresses, just as match would.
+
+        The addresses are gathered into columns of row numbers by value, each distinct value is
+        looked up once and each geo is evaluated by set operations over the rows having values it
+        needs, so only the few rows that pass a geo's rule are visited for it. Addresses matching
+        nothing share NO_MATCH.
+        """
+        results: list = [NO_MATCH] * len(addresses)
+        full_rows, parsed_rows, columns = gather_columns(addresses)
+
+        # Rows of each (geo, role) found in ADDR_FULL, and of each geo's exact and contained values
+        full_hits = {}
+        full_role_rows: dict[tuple[str, str], list[int]] = {}
+        for addr_full, rows in full_rows.items():
+            hits = self.full_hits(addr_full)
+            if hits:
+                full_hits[addr_full] = hits
+                for geo_role in hits:
+                    full_role_rows.setdefault(geo_role, []).extend(rows)
+        exact_rows: dict[str, dict[str, list[int]]] = {"cities": {}, "states": {}}
+        for role, role_rows in exact_rows.items():
+            for value, rows in columns[role].items():
+                for geo in self.exact_lookup[role].get(value, ()):
+                    role_rows.setdefault(geo, []).extend(rows)
+        contains_rows: dict[str, set[int]] = {}
+        for role in ("cities", "countries"):
+            if self.contains_lookup[role]:
+                for value, rows in columns[role].items():
+                    for geo in self.contains_hits(role, value):
+                        contains_rows.setdefault(geo, set()).update(rows)
+
+        all_full_rows = [row for rows in full_rows.values() for row in rows]
+        country_lookup = self.exact_lookup["countries"]
+        for geo, function, any_city, any_state, postal_codes in self.geo_rules:
+            if function == "pure_config":
+                passed_rows = passed_by_role(
+                    all_full_rows,
+                    full_role_rows.get((geo, "cities"), []),
+                    full_role_rows.get((geo, "states"), []),
+                    any_city,
+                    any_state,
+                )
+                if postal_codes:
+                    passed_rows = [
+                        row for row in passed_rows if any(f" {s}" in addresses[row]["ADDR_FULL"] for s in postal_codes)
+                    ]
+            else:
+                passed_rows = full_role_rows.get((geo, "cities"), [])
+            for row in passed_rows:
+                addr_data = addresses[row]
+                if addr_data["ADDR_COUNTRY"]:
+                    in_country = geo in country_lookup.get(addr_data["ADDR_COUNTRY"], ())
+                else:
+                    in_country = (geo, "countries") in full_hits.get(addr_data["ADDR_FULL"], ())
+                if results[row] is NO_MATCH:
+                    results[row] = ([], [])
+                results[row][0 if in_country else 1].append(geo)
+
+            if function == "pure_config":
+                passed_rows = passed_by_role(
+                    parsed_rows,
+                    exact_rows["cities"].get(geo, []),
+                    exact_rows["states"].get(geo, []),
+                    any_city,
+                    any_state,
+                )
+                if postal_codes:
+                    passed_rows = [
+                        row
+                        for row in passed_rows
+                        if any(addresses[row]["ADDR_POSTAL_CODE"].startswith(s) for s in postal_codes)
+                    ]
+            else:
+                passed_rows = contains_rows.get(geo, [])
+            for row in passed_rows:
+                addr_country = addresses[row]["ADDR_COUNTRY"]
+                in_country = not addr_country or geo in country_lookup.get(addr_country, ())
+                if results[row] is NO_MATCH:
+                    results[row] = ([], [])
+                results[row][0 if in_country else 1].append(geo)
+
+        if self.function_rules:
+            for row, addr_data in enumerate(addresses):
+                if results[row] is NO_MATCH:
+                    results[row] = ([], [])
+                self.match_functions(addr_data, *results[row])
+        return results
+
+    def match_functions(self, addr_data, matched_geos, rejected_geos):
+        """Add the results of the geos that are not compiled, calling their registered match functions."""
+        for geo, match_function, geo_config in self.function_rules:
+            if match_function(geo_config, addr_data):
+                (matched_geos if country_matches(geo_config, addr_data) else rejected_geos).append(geo)
+
+
+def gather_columns(addresses):
+    """Return the rows of each ADDR_FULL value, the rows with parsed addresses and the rows of each of their values by role."""
+    full_rows: dict[str, list[int]] = {}
+    parsed_rows = []
+    columns: dict[str, dict[str, list[int]]] = {"cities": {}, "states": {}, "countries": {}}
+    for row, addr_data in enumerate(addresses):
+        if addr_data["HAS_ADDR_FULL"]:
+            full_rows.setdefault(addr_data["ADDR_FULL"], []).append(row)
+        else:
+            parsed_rows.append(row)
+            columns["cities"].setdefault(addr_data["ADDR_CITY"], []).append(row)
+            columns["states"].setdefault(addr_data["ADDR_STATE"], []).append(row)
+            columns["countries"].setdefault(addr_data["ADDR_COUNTRY"], []).append(row)
+    return full_rows, parsed_rows, columns
+
+
+def passed_by_role(all_rows, city_rows, state_rows, any_city, any_state):
+    """Return the rows passing a pure_config geo's city and state rules, before its postal codes are checked."""
+    if any_city and any_state:
+        return all_rows
+    if any_city:
+        return state_rows
+    if any_state:
+        return city_rows
+    return set(city_rows).intersection(state_rows)
+
+
+class GeoPrefilter:  # pylint: disable=too-few-public-methods
+    """Conservative test of a raw source line that rejects lines no target geo can match.
+
+    Every way an address can match or be rejected on country needs one of the geo's configured
+    cities, states, countries or postal codes to appear in it, so a line containing none of them
+    can be skipped before it is parsed. Each value is searched for by its longest run of word
+    characters since commas become spaces in ADDR_FULL, leaving out runs that contain a shorter
+    one. ASCII runs are searched for in the lowercased line bytes, lines with other characters are
+    also decoded and lowercased the way the parsed addresses are, and lines with JSON \\u escapes
+    are never skipped.
+    """
+
+    def __init__(self, geos, target_geos):
+        tokens = set()
+        for geo in target_geos:
+            geo_config = geos[geo]
+            if geo_config["function"] not in COMPILED_FUNCTIONS:
+                raise ValueError(
+                    f"geo {geo} uses the {geo_config['function']} match function which cannot be prefiltered"
+                )
+            if geo_config["function"] == "pure_config" and not any(
+                geo_config.get(role) for role in ("cities", "states", "postal_codes")
+            ):
+                raise ValueError(f"geo {geo} can match addresses without a configured city, state or postal code")
+            for role in PREFILTER_ROLES:
+                for value in geo_config.get(role, []):
+                    value_runs = re.findall(r"\w+", value.lower())
+                    if not value_runs:
+                        raise ValueError(f"geo {geo} {role} value {value!r} has no letters or digits to search for")
+                    tokens.add(max(value_runs, key=len))
+        self.text_tokens: list[str] = []
+        for token in sorted(tokens, key=len):
+            if not any(shorter_token in token for shorter_token in self.text_tokens):
+                self.text_tokens.append(token)
+        self.ascii_tokens = [token.encode() for token in self.text_tokens if token.isascii()]
+
+    def may_match(self, line):
+        """Return False only if a raw source line cannot match any of the target geos."""
+        lowered_line = line.lower()
+        if b"\\u" in lowered_line or any(token in lowered_line for token in self.ascii_tokens):
+            return True
+        if line.isascii():
+            return False
+        text = line.decode("utf-8", "replace").lower()
+        return any(token in text for token in self.text_tokens)
@@ -1,129 +1,313 @@
 """Collect feature statistics from JSONL files and update Excel spreadsheet."""
 
+import argparse
 import glob
+import hashlib
+import multiprocessing
 import os
 import sys
 from copy import copy
 from datetime import datetime
 from typing import Any
 
+import orjson
 from openpyxl import load_workbook
 
-from json2attribute import json2attribute
+from geo_extractor import SENZING_CONFIG_FILE, load_parser
+from shard_pool import init_worker
+from stream_io import (
+    COMPRESSION_EXTENSIONS,
+    COPY_CHUNK_SIZE,
+    detect_compression,
+    open_source,
+    split_source,
+)
 
-json_parser = json2attribute("sz_default_config.json")
+STATS_CACHE_VERSION = 1
 
 
-if len(sys.argv) != 2:
-    print("\nsyntax:\n\tpython3 get_cord_stats <directory>\n")
-    sys.exit(1)
+def source_geo(file_name):
+    """Return the source and geo of an extracted file from its name."""
+    base_name = os.path.basename(file_name)
+    for extension in COMPRESSION_EXTENSIONS.values():
+        base_name = base_name.removesuffix(extension)
+    source, geo = base_name.replace(".jsonl", "").split("-")
+    return source, geo
 
 
-file_spec = sys.argv[1]
-if os.path.isdir(file_spec):
-    dir_name = file_spec
-    file_spec += os.path.sep + "*.jsonl"
-else:
-    dir_name = os.path.dirname(file_spec)
+def plan_ranges(file_list, workers):
+    """Split the files into (file_idx, range_idx, file_name, start, end) tasks, sharing the workers by file size.
 
-file_list = glob.glob(file_spec)
-if len(file_list) == 0:
-    print("\nno files found!\n")
-    sys.exit(1)
+    Compressed files cannot be split into byte ranges so they are counted whole by a single worker.
+    """
+    file_sizes = [os.path.getsize(file_name) for file_name in file_list]
+    total_size = sum(file_sizes) or 1
+    range_tasks = []
+    for file_idx, (file_name, file_size) in enumerate(zip(file_list, file_sizes)):
+        range_cnt = max(1, round(workers * file_size / total_size))
+        ranges: list[tuple[int, int | None]] = [(0, None)]
+        if range_cnt > 1 and not detect_compression(file_name):
+            ranges = list(split_source(file_name, range_cnt)) or ranges
+        for range_idx, (start, end) in enumerate(ranges):
+            range_size = file_size if end is None else end - start
+            range_tasks.append((range_size, (file_idx, range_idx, file_name, start, end)))
+    range_tasks.sort(key=lambda x: x[0], reverse=True)
+    return [range_task for _, range_task in range_tasks]
 
-stats_file = dir_name + os.path.sep + "_CORD_STATS.xlsx"
-if not os.path.exists(stats_file):
-    print(f"\n{stats_file} not found!\n")
-    sys.exit(1)
 
-wb = load_workbook(stats_file)
-ws = wb.worksheets[0]
-column_header = list(next(ws.values))
+def count_range(range_task):
+    """Pool task that counts the records, record types and features of the lines starting within a byte range."""
+    file_idx, range_idx, file_name, start, end = range_task
+    json_parser = load_parser(SENZING_CONFIG_FILE)
+    range_counts = {"RECORD_COUNT": 0}
+    with open_source(file_name, detect_compression(file_name)) as f:
+        if start:
+            f.seek(start)
+        position = start
+        for line in f:
+            if end is not None and position >= end:
+                break
+            position += len(line)
+            for ftype_code, attr_value in json_parser.features(line):
+                if ftype_code == "RECORD_TYPE":
+                    column_name = f"{attr_value}_COUNT"
+                else:
+                    column_name = f"{ftype_code}_FEATURES"
+                range_counts[column_name] = range_counts.get(column_name, 0) + 1
+            range_counts["RECORD_COUNT"] += 1
+            if range_counts["RECORD_COUNT"] % 100000 == 0:
+                print(f"{range_counts['RECORD_COUNT']} rows processed for {file_name}", flush=True)
+    return file_idx, range_idx, range_counts
 
-record_types: list[str] = []
-features: list[str] = []
-stat_pack: dict[str, Any] = {}
 
-any_updates = False
+def count_files(file_list, workers):
+    """Count each file, in byte ranges across a process pool when using multiple workers, merging the range counts."""
+    range_tasks = plan_ranges(file_list, workers)
+    range_cnts = [0] * len(file_list)
+    for file_idx, _, _, _, _ in range_tasks:
+        range_cnts[file_idx] += 1
+    range_results: list[dict[int, dict[str, int]]] = [{} for _ in file_list]
+    file_counts: list[dict[str, int]] = [{} for _ in file_list]
 
-for file_name in file_list:
-    with open(file_name, "r", encoding="utf-8") as f:
-        source, geo = os.path.basename(file_name).replace(".jsonl", "").split("-")
-        column_values: dict[str, Any] = {"SOURCE": source, "GEO": geo, "RECORD_COUNT": 0}
-        for line in f:
-            attr_list = json_parser.parse(line)
-            for attr_data in attr_list:
-                if not attr_data.get("FTYPE_CODE"):
-                    continue
-                if attr_data["FTYPE_CODE"] == "RECORD_TYPE":
-                    column_name = f"{attr_data['ATTR_VALUE']}_COUNT"
-                else:
-                    column_name = f"{attr_data['FTYPE_CODE']}_FEATURES"
-                if column_name in column_values:
-                    column_values[column_name] += 1
-                else:
-                    column_values[column_name] = 1
-            column_values["RECORD_COUNT"] += 1
-            if column_values["RECORD_COUNT"] % 100000 == 0:
-                print(f"{column_values['RECORD_COUNT']} rows processed for {file_name}")
-
-        print(f"{column_values['RECORD_COUNT']} rows processed for {file_name}, complete!")
-
-        row_found = False
-        row_idx = 0
-        for row in ws.iter_rows():
-            row_idx += 1
-            if row[column_header.index("SOURCE")].value == source and row[column_header.index("GEO")].value == geo:
-                row_found = True
-                print("FOUND!")
-                break
+    def merge_result(file_idx, range_idx, range_counts):
+        range_results[file_idx][range_idx] = range_counts
+        if len(range_results[file_idx]) < range_cnts[file_idx]:
+            return
+        # Merge in file order so columns are added in the order they first appear
+        for merge_idx in range(range_cnts[file_idx]):
+            for column_name, column_value in range_results[file_idx].pop(merge_idx).items():
+                file_counts[file_idx][column_name] = file_counts[file_idx].get(column_name, 0) + column_value
+        print(f"{file_counts[file_idx]['RECORD_COUNT']} rows processed for {file_list[file_idx]}, complete!")
+
+    if workers == 1:
+        for range_task in range_tasks:
+            merge_result(*count_range(range_task))
+    else:
+        with multiprocessing.Pool(workers, initializer=init_worker) as pool:
+            for file_idx, range_idx, range_counts in pool.imap_unordered(count_range, range_tasks):
+                merge_result(file_idx, range_idx, range_counts)
+    return file_counts
+
+
+def file_signature(file_name, use_hash):
+    """Return the size, modification time and optionally content hash a file's cached counts are valid for."""
+    file_stat = os.stat(file_name)
+    signature = {"size": file_stat.st_size, "mtime": file_stat.st_mtime_ns}
+    if use_hash:
+        file_hash = hashlib.sha256()
+        with open(file_name, "rb") as f:
+            while chunk := f.read(COPY_CHUNK_SIZE):
+                file_hash.update(chunk)
+        signature["hash"] = file_hash.hexdigest()
+    return signature
+
+
+def is_cached(cache_entry, signature):
+    """Return True if cached counts are still valid, by content hash when there is one or else by modification time."""
+    if not cache_entry or cache_entry["size"] != signature["size"]:
+        return False
+    if "hash" in signature:
+        return cache_entry.get("hash") == signature["hash"]
+    return cache_entry["mtime"] == signature["mtime"]
+
+
+def load_stats_cache(cache_file):
+    """Return the cached counts by file path, or an empty cache if there is no usable cache file."""
+    try:
+        with open(cache_file, "rb") as f:
+            cache_data = orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return {}
+    if cache_data.get("version") != STATS_CACHE_VERSION:
+        return {}
+    return cache_data["files"]
+
+
+def save_stats_cache(cache_file, stats_cache):
+    """Write the cached counts by file path, replacing the cache file atomically."""
+    with open(cache_file + ".part", "wb") as f:
+        f.write(orjson.dumps({"version": STATS_CACHE_VERSION, "files": stats_cache}))
+    os.replace(cache_file + ".part", cache_file)
+
+
+def index_rows(ws, column_header):
+    """Map the (SOURCE, GEO) of each worksheet row to its row number."""
+    source_col = column_header.index("SOURCE")
+    geo_col = column_header.index("GEO")
+    row_lookup = {}
+    for row_idx, row_values in enumerate(ws.iter_rows(min_row=2, values_only=True), 2):
+        row_lookup.setdefault((row_values[source_col], row_values[geo_col]), row_idx)
+    return row_lookup
 
-        if not row_found:  # insert new row with formatting
-            last_row = ws[row_idx]
-            row_idx += 1
-            ws.insert_rows(idx=row_idx, amount=1)
-            row = ws[row_idx]
-            for i, last_cell in enumerate(last_row):
-                if last_cell.has_style:
-                    row[i].font = copy(last_cell.font)
-                    row[i].border = copy(last_cell.border)
-                    row[i].fill = copy(last_cell.fill)
-                    row[i].number_format = copy(last_cell.number_format)
-                    row[i].protection = copy(last_cell.protection)
-                    row[i].alignment = copy(last_cell.alignment)
-                row[i].value = 0
+
+def find_files(file_spec):
+    """Return the directory and the extracted files of a file spec, a directory or a file name or pattern."""
+    if os.path.isdir(file_spec):
+        file_list = glob.glob(file_spec + os.path.sep + "*.jsonl")
+        for extension in COMPRESSION_EXTENSIONS.values():
+            file_list.extend(glob.glob(file_spec + os.path.sep + "*.jsonl" + extension))
+        return file_spec, file_list
+    return os.path.dirname(file_spec), glob.glob(file_spec)
+
+
+def cached_counts(file_list, cache_file, options):
+    """Return the counts of each file, only counting the files that are new or changed since they were cached."""
+    stats_cache = {
+        file_path: cache_entry
+        for file_path, cache_entry in load_stats_cache(cache_file).items()
+        if os.path.exists(file_path)
+    }
+    file_paths = [os.path.abspath(file_name) for file_name in file_list]
+    file_signatures = [file_signature(file_name, options.hash) for file_name in file_list]
+    changed_files = [
+        (file_name, file_path, signature)
+        for file_name, file_path, signature in zip(file_list, file_paths, file_signatures)
+        if not is_cached(stats_cache.get(file_path), signature)
+    ]
+    print(f"{len(file_list) - len(changed_files)} of {len(file_list)} files unchanged since the last run")
+    if changed_files:
+        # Loaded once here, pool workers load their own on their first range
+        load_parser(SENZING_CONFIG_FILE)
+        changed_counts = count_files([file_name for file_name, _, _ in changed_files], options.workers)
+        for (_, file_path, signature), counts in zip(changed_files, changed_counts):
+            stats_cache[file_path] = {**signature, "counts": counts}
+        save_stats_cache(cache_file, stats_cache)
+    return [stats_cache[file_path]["counts"] for file_path in file_paths]
+
+
+def insert_row(ws):
+    """Append a zeroed row formatted like the last row of the worksheet, returning its index."""
+    last_row = ws[ws.max_row]
+    row_idx = ws.max_row + 1
+    ws.insert_rows(idx=row_idx, amount=1)
+    row = ws[row_idx]
+    for i, last_cell in enumerate(last_row):
+        if last_cell.has_style:
+            row[i].font = copy(last_cell.font)
+            row[i].border = copy(last_cell.border)
+            row[i].fill = copy(last_cell.fill)
+            row[i].number_format = copy(last_cell.number_format)
+            row[i].protection = copy(last_cell.protection)
+            row[i].alignment = copy(last_cell.alignment)
+        row[i].value = 0
+    return row_idx
+
+
+def update_row(ws, row_idx, column_header, column_values):
+    """Set a row's columns to the counted values, adding new columns, and return whether any value changed."""
+    row = ws[row_idx]
+    updated = False
+    for column_name, column_value in column_values.items():
+        if column_name not in column_header:
+            column_header.append(column_name)
+            # ws.insert_cols()
+            ws.cell(row=1, column=len(column_header)).value = column_name
+            ws.cell(row=row_idx, column=len(column_header)).value = column_value
+            # row[column_header.index(column_name)].value = column_value
+            updated = True
+        elif row[column_header.index(column_name)].value != column_value:
+            row[column_header.index(column_name)].value = column_value
+            updated = True
+    for column_name in column_header:  # remove values no longer present
+        if column_name in column_values or column_name == "LAST_UPDATED":
+            continue
+        if row[column_header.index(column_name)].value:
+            row[column_header.index(column_name)].value = 0
+            updated = True
+    if updated:
+        row[column_header.index("LAST_UPDATED")].value = datetime.today()
+    return updated
+
+
+def main():
+    """Count the features of the extracted files and update their rows of the statistics spreadsheet."""
+    arg_parser = argparse.ArgumentParser(
+        allow_abbrev=False, description="Utility to update _CORD_STATS.xlsx with the features of extracted JSONL files"
+    )
+    arg_parser.add_argument("file_spec", help="directory of extracted JSONL files, or a file name or pattern")
+    arg_parser.add_argument(
+        "-w",
+        "--workers",
+        default=os.cpu_count() or 1,
+        dest="workers",
+        metavar="int",
+        type=int,
+        help="number of processes to count the files with, default = %(default)s",
+    )
+    arg_parser.add_argument(
+        "--hash",
+        dest="hash",
+        action="store_true",
+        default=False,
+        help="reuse cached counts by content hash instead of modification time",
+    )
+    cli_args = arg_parser.parse_args()
+    if cli_args.workers < 1:
+        arg_parser.error("--workers must be at least 1")
+
+    dir_name, file_list = find_files(cli_args.file_spec)
+    if len(file_list) == 0:
+        print("\nno files found!\n")
+        sys.exit(1)
+
+    stats_file = dir_name + os.path.sep + "_CORD_STATS.xlsx"
+    if not os.path.exists(stats_file):
+        print(f"\n{stats_file} not found!\n")
+        sys.exit(1)
+
+    file_counts = cached_counts(file_list, dir_name + os.path.sep + "_CORD_STATS.cache.json", cli_args)
+
+    wb = load_workbook(stats_file)
+    ws = wb.worksheets[0]
+    column_header = list(next(ws.values))
+    row_lookup = index_rows(ws, column_header)
+
+    any_updates = False
+
+    for file_name, counts in zip(file_list, file_counts):
+        source, geo = source_geo(file_name)
+        column_values: dict[str, Any] = {"SOURCE": source, "GEO": geo, **counts}
+
+        row_idx = row_lookup.get((source, geo))
+        if row_idx:
+            print("FOUND!")
         else:
-            row = ws[row_idx]
-
-        updated = False
-        for column_name, column_value in column_values.items():
-            if column_name not in column_header:
-                column_header.append(column_name)
-                # ws.insert_cols()
-                ws.cell(row=1, column=len(column_header)).value = column_name
-                ws.cell(row=row_idx, column=len(column_header)).value = column_value
-                # row[column_header.index(column_name)].value = column_value
-                updated = True
-            elif row[column_header.index(column_name)].value != column_value:
-                row[column_header.index(column_name)].value = column_value
-                updated = True
-        for column_name in column_header:  # remove values no longer present
-            if column_name in column_values or column_name == "LAST_UPDATED":
-                continue
-            if row[column_header.index(column_name)].value:
-                row[column_header.index(column_name)].value = 0
-                updated = True
-
-        if updated:
-            row[column_header.index("LAST_UPDATED")].value = datetime.today()
+            row_idx = row_lookup[(source, geo)] = insert_row(ws)
+
+        if update_row(ws, row_idx, column_header, column_values):
             print(f"-->> updated {file_name}")
             any_updates = True
 
+    if any_updates:
+        backup_file = stats_file + ".bak"
+        if os.path.exists(backup_file):
+            os.remove(backup_file)
+        os.rename(stats_file, backup_file)
+        wb.save(stats_file)
+        print("updates saved!")
+    else:
+        print("no updates needed!")
+
 
-if any_updates:
-    backup_file = stats_file + ".bak"
-    if os.path.exists(backup_file):
-        os.remove(backup_file)
-    os.rename(stats_file, backup_file)
-    wb.save(stats_file)
-    print("updates saved!")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Space-Saving summaries of the most frequent values of a stream, in memory bounded by a capacity."""
+
+
+def new_summary(capacity):
+    """Return an empty summary that keeps counts for about capacity values.
+
+    The summary is a plain dict so it can be returned from pool workers, saved in checkpoints and
+    merged across shards. Counts are kept as [count, error] where count is an upper bound on how
+    often the value was added and count - error a lower bound, so a count with no error is exact.
+    """
+    return {"capacity": capacity, "total": 0, "floor": 0, "counts": {}}
+
+
+def add_value(summary, value, cnt=1):
+    """Count cnt more occurrences of a value.
+
+    A value not being counted starts from the floor, the highest count dropped so far, which bounds
+    how often it may have been added before. The counts are allowed to grow to twice the capacity
+    before the lowest are dropped, so adding a value takes amortized constant time.
+    """
+    summary["total"] += cnt
+    counts = summary["counts"]
+    if value in counts:
+        counts[value][0] += cnt
+        return
+    counts[value] = [summary["floor"] + cnt, summary["floor"]]
+    if len(counts) > 2 * summary["capacity"]:
+        prune_summary(summary)
+
+
+def prune_summary(summary):
+    """Drop all but the capacity highest counts, raising the floor to the highest count dropped."""
+    counts = summary["counts"]
+    if len(counts) <= summary["capacity"]:
+        return
+    ranked = sorted(counts.items(), key=lambda x: x[1][0], reverse=True)
+    summary["floor"] = max(summary["floor"], ranked[summary["capacity"]][1][0])
+    summary["counts"] = dict(ranked[: summary["capacity"]])
+
+
+def merge_summary(summary, other_summary):
+    """Add another summary, such as a shard's, into summary.
+
+    A value counted by only one of them may have been dropped by the other, so it is charged the
+    other's floor as both count and error, which keeps the bounds of the merged counts.
+    """
+    counts = summary["counts"]
+    floor = summary["floor"]
+    other_counts = other_summary["counts"]
+    other_floor = other_summary["floor"]
+    for value, count_error in counts.items():
+        if value not in other_counts:
+            count_error[0] += other_floor
+            count_error[1] += other_floor
+    for value, (other_count, other_error) in other_counts.items():
+        if value in counts:
+            counts[value][0] += other_count
+            counts[value][1] += other_error
+        else:
+            counts[value] = [other_count + floor, other_error + floor]
+    summary["capacity"] = max(summary["capacity"], other_summary["capacity"])
+    summary["total"] += other_summary["total"]
+    summary["floor"] = floor + other_floor
+    prune_summary(summary)
+
+
+def top_counts(summary, limit=None):
+    """Return the highest counts of a summary as dicts of value, count and error, highest first."""
+    ranked = sorted(summary["counts"].items(), key=lambda x: (-x[1][0], x[0]))[:limit]
+    return [{"value": value, "count": count, "error": error} for value, (count, error) in ranked]
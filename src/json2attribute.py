@@ -1,27 +1,122 @@
 """Parse Senzing JSON records into normalized attribute lists."""
 
-from operator import itemgetter
+import hashlib
+import os
+import sys
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Any, NamedTuple
 
 import orjson
 
+DEFAULT_CACHE_SIZE = 4096
+DEFAULT_COMPILED_DIR = os.environ.get(
+    "JSON2ATTRIBUTE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "json2attribute")
+)
+COMPILED_VERSION = 2
+ATTR_COLUMNS = ("ATTR_ID", "ATTR_CODE", "ATTR_CLASS", "FTYPE_CODE", "FELEM_CODE")
+FTYPE_COLUMNS = ("FTYPE_ID", "FTYPE_CODE")
+
+
+class AttrRecord(NamedTuple):
+    """An attribute of a parsed record, with the fields of the dicts parse() returns."""
+
+    SEGMENT: str
+    ATTR_ID: int
+    ATTRIBUTE: str
+    FTYPE_CODE: str | None
+    ATTR_VALUE: str
+    USAGE_TYPE: Any
+    USED_FROM_DT: Any
+    USED_THRU_DT: Any
+    ATTR_JSON: dict
+
+
+def intern_code(code):
+    """Intern a config code so every resolved key shares one string object per code."""
+    return sys.intern(code) if isinstance(code, str) else code
+
+
+def compile_config(cfg_bytes):
+    """Return the compact form of a Senzing config holding just what the parser uses.
+
+    Attributes are kept as rows of the ATTR_COLUMNS the parser reads, keyed by ATTR_CODE, to keep
+    the cache file small; json2attribute expands them into the attr_lookup dicts record keys and
+    their usage labelled forms are resolved against.
+    """
+    cfg_data = orjson.loads(cfg_bytes)
+    return {
+        "version": COMPILED_VERSION,
+        "attrs": {
+            record["ATTR_CODE"]: [record.get(column) for column in ATTR_COLUMNS]
+            for record in cfg_data["G2_CONFIG"]["CFG_ATTR"]
+        },
+        "ftypes": {
+            record["FTYPE_CODE"]: {column: record.get(column) for column in FTYPE_COLUMNS}
+            for record in cfg_data["G2_CONFIG"]["CFG_FTYPE"]
+        },
+    }
+
+
+def config_signature(cfg_file):
+    """Return the path, size and modification time a compiled config is valid for."""
+    cfg_stat = os.stat(cfg_file)
+    return {"path": os.path.abspath(cfg_file), "size": cfg_stat.st_size, "mtime": cfg_stat.st_mtime_ns}
+
+
+def load_compiled_config(cfg_file, compiled_dir=DEFAULT_COMPILED_DIR):
+    """Return the compiled form of a Senzing config file, cached in compiled_dir by the path of the file.
+
+    The cache is used while the config file keeps the size and modification time it was compiled
+    from, so loading it does not read the config file. A missing, stale or unreadable cache file is
+    compiled again and, when compiled_dir can be written to, replaced atomically so pool workers
+    compiling at the same time never read a partial file.
+    """
+    if not compiled_dir:
+        with open(cfg_file, "rb") as f:
+            return compile_config(f.read())
+    signature = config_signature(cfg_file)
+    path_hash = hashlib.sha256(signature["path"].encode()).hexdigest()
+    compiled_file = os.path.join(compiled_dir, f"{os.path.basename(cfg_file)}.{path_hash[:32]}.json")
+    try:
+        with open(compiled_file, "rb") as f:
+            compiled = orjson.loads(f.read())
+        if compiled.get("version") == COMPILED_VERSION and compiled.get("source") == signature:
+            return compiled
+    except (OSError, orjson.JSONDecodeError):
+        pass
+    with open(cfg_file, "rb") as f:
+        compiled = {**compile_config(f.read()), "source": signature}
+    temp_file_name = f"{compiled_file}.{os.getpid()}.part"
+    try:
+        os.makedirs(compiled_dir, exist_ok=True)
+        with open(temp_file_name, "wb") as f:
+            f.write(orjson.dumps(compiled))
+        os.replace(temp_file_name, compiled_file)
+    except OSError:
+        pass
+    return compiled
+
 
 class json2attribute:  # pylint: disable=invalid-name
     """Parser that converts JSON records to attribute lists using Senzing config."""
 
-    def __init__(self, cfg_file):
-        self.attr_lookup = {}
-        self.feature_lookup = {}
+    def __init__(self, cfg_file, cache_size=DEFAULT_CACHE_SIZE, compiled_dir=DEFAULT_COMPILED_DIR):
         self.attr_groups = {}
         self.attr_list = []
-        with open(cfg_file, encoding="utf-8") as f:
-            cfg_data = orjson.loads(f.read())
-        for record in cfg_data["G2_CONFIG"]["CFG_ATTR"]:
-            self.attr_lookup[record["ATTR_CODE"]] = record
-        for record in cfg_data["G2_CONFIG"]["CFG_FTYPE"]:
-            self.feature_lookup[record["FTYPE_CODE"]] = record
+        # Record keys repeat across every record, so their resolution is cached per instance
+        self.resolve_attribute = lru_cache(maxsize=cache_size)(self._resolve_attribute)
+        self.resolve_key = lru_cache(maxsize=cache_size)(self._resolve_key)
+        compiled = load_compiled_config(cfg_file, compiled_dir)
+        self.attr_lookup = {
+            attr_code: dict(zip(ATTR_COLUMNS, attr_row)) for attr_code, attr_row in compiled["attrs"].items()
+        }
+        self.feature_lookup = compiled["ftypes"]
 
     def parse(self, json_string, rtn_value="attr_list"):
-        """Parse JSON string and return attribute list or groups."""
+        """Parse JSON string and return attribute list, attribute records or groups."""
+        if rtn_value == "attr_records":
+            return self.parse_records(json_string)
         json_data = orjson.loads(json_string)
         self.attr_groups = {}
         for attribute in (x for x in json_data if json_data[x]):
@@ -30,16 +125,19 @@ class json2attribute:  # pylint: disable=invalid-name
                 for child_data in json_data[attribute]:
                     i += 1
                     for record_attribute in (x for x in child_data if child_data[x]):
-                        attr_data = self.lookup_attribute(record_attribute.upper(), child_data[record_attribute])
+                        attr_template = self.resolve_attribute(record_attribute.upper())
                         segment_id = f"{attribute}-{i}"
-                        self.update_grouping(segment_id, attr_data)
+                        self.update_grouping(segment_id, attr_template, child_data[record_attribute])
             else:
-                attr_data = self.lookup_attribute(attribute.upper(), json_data[attribute])
+                attr_template = self.resolve_attribute(attribute.upper())
                 segment_id = "ROOT"
-                self.update_grouping(segment_id, attr_data)
+                self.update_grouping(segment_id, attr_template, json_data[attribute])
 
         if rtn_value == "attr_groups":
-            return self.attr_groups
+            return {
+                segment_id: [{**attr_template, "ATTR_VALUE": attr_value} for attr_template, attr_value in group_data]
+                for segment_id, group_data in self.attr_groups.items()
+            }
 
         self.attr_list = []
         for segment_id, group_data in self.attr_groups.items():
@@ -48,25 +146,25 @@ class json2attribute:  # pylint: disable=invalid-name
             attr_values = []
             attr_json = {}
             used_from_date = used_thru_date = None
-            for attr_data in sorted(group_data, key=itemgetter("ATTR_ID")):
-                min_attr_id = min(min_attr_id, attr_data.get("ATTR_ID"))
-                if attr_data.get("FELEM_CODE") == "USAGE_TYPE":
-                    usage_type = attr_data["ATTR_VALUE"]
-                elif attr_data.get("FELEM_CODE") == "USED_FROM_DT":
-                    used_from_date = attr_data["ATTR_VALUE"]
-                elif attr_data.get("FELEM_CODE") == "USED_THRU_DT":
-                    used_thru_date = attr_data["ATTR_VALUE"]
-                # elif attr_data.get('FELEM_CODE') == 'KEY_TYPE' and attribute == 'REL_POINTER':
+            for attr_template, attr_value in sorted(group_data, key=lambda x: x[0]["ATTR_ID"]):
+                min_attr_id = min(min_attr_id, attr_template.get("ATTR_ID"))
+                if attr_template.get("FELEM_CODE") == "USAGE_TYPE":
+                    usage_type = attr_value
+                elif attr_template.get("FELEM_CODE") == "USED_FROM_DT":
+                    used_from_date = attr_value
+                elif attr_template.get("FELEM_CODE") == "USED_THRU_DT":
+                    used_thru_date = attr_value
+                # elif attr_template.get('FELEM_CODE') == 'KEY_TYPE' and attribute == 'REL_POINTER':
                 #    continue # simply ignoring optional domain for rel_pointers
                 else:
-                    attr_values.append(str(attr_data["ATTR_VALUE"]))
-                    attr_json[attr_data["ATTR_CODE"]] = attr_data["ATTR_VALUE"]
+                    attr_values.append(str(attr_value))
+                    attr_json[attr_template["ATTR_CODE"]] = attr_value
             self.attr_list.append(
                 {
                     "SEGMENT": segment,
                     "ATTR_ID": min_attr_id,
                     "ATTRIBUTE": attribute,
-                    "FTYPE_CODE": attr_data.get("FTYPE_CODE"),
+                    "FTYPE_CODE": attr_template.get("FTYPE_CODE"),
                     "ATTR_VALUE": " ".join(attr_values),
                     "USAGE_TYPE": usage_type,
                     "USED_FROM_DT": used_from_date,
@@ -76,34 +174,202 @@ class json2attribute:  # pylint: disable=invalid-name
             )
         return self.attr_list
 
-    def lookup_attribute(self, attr_name, attr_value):
-        """Look up attribute definition from config and return attribute data dict."""
+    def parse_records(self, json_string):
+        """Return the attributes parse() does as AttrRecord tuples, with much less allocation per record.
+
+        Keys are grouped on (segment, position, attribute, usage label) tuples holding the cached
+        resolved keys, so no segment ids are formatted and split and no config templates copied.
+        """
+        json_data = orjson.loads(json_string)
+        groups: dict[tuple, list] = {}
+        resolve_key = self.resolve_key
+        for attribute, attr_value in json_data.items():
+            if not attr_value:
+                continue
+            if isinstance(attr_value, list):
+                i = 0
+                for child_data in attr_value:
+                    i += 1
+                    for record_attribute, child_value in child_data.items():
+                        if child_value:
+                            key_data = resolve_key(record_attribute)
+                            groups.setdefault((attribute, i, key_data[0], key_data[1]), []).append(
+                                (key_data, child_value)
+                            )
+            else:
+                key_data = resolve_key(attribute)
+                groups.setdefault(("ROOT", 0, key_data[0], key_data[1]), []).append((key_data, attr_value))
+
+        attr_records = []
+        for (segment, i, attribute, usage_type), group_data in groups.items():
+            if len(group_data) > 1:
+                group_data.sort(key=lambda x: x[0][2])
+            attr_values = []
+            attr_json = {}
+            used_from_date = used_thru_date = None
+            for (_, _, _, felem_code, attr_code, _), attr_value in group_data:
+                if felem_code == "USAGE_TYPE":
+                    usage_type = attr_value
+                elif felem_code == "USED_FROM_DT":
+                    used_from_date = attr_value
+                elif felem_code == "USED_THRU_DT":
+                    used_thru_date = attr_value
+                else:
+                    attr_values.append(str(attr_value))
+                    attr_json[attr_code] = attr_value
+            attr_records.append(
+                AttrRecord(
+                    f"{segment}-{i}" if i else segment,
+                    min(9999, group_data[0][0][2]),
+                    attribute,
+                    group_data[-1][0][5],
+                    " ".join(attr_values),
+                    usage_type,
+                    used_from_date,
+                    used_thru_date,
+                    attr_json,
+                )
+            )
+        return attr_records
+
+    def extract(self, json_string, attributes=("ADDRESS", "NAME", "RECORD_TYPE")):
+        """Yield just the requested attributes of a JSON record without the full parse.
+
+        Each attribute has the same SEGMENT, ATTRIBUTE, USAGE_TYPE, ATTR_VALUE and ATTR_JSON values
+        parse() returns for it, but keys of other attributes are dropped before any grouping.
+        """
+        json_data = orjson.loads(json_string)
+        groups = {}
+        for attribute, attr_value in json_data.items():
+            if not attr_value:
+                continue
+            if isinstance(attr_value, list):
+                i = 0
+                for child_data in attr_value:
+                    i += 1
+                    for record_attribute, child_value in child_data.items():
+                        if not child_value:
+                            continue
+                        key_data = self.resolve_key(record_attribute)
+                        if key_data[0] in attributes:
+                            groups.setdefault((attribute, i, key_data[0], key_data[1]), []).append(
+                                (key_data, child_value)
+                            )
+            else:
+                key_data = self.resolve_key(attribute)
+                if key_data[0] in attributes:
+                    groups.setdefault(("ROOT", 0, key_data[0], key_data[1]), []).append((key_data, attr_value))
+
+        for (segment, i, attribute, usage_type), group_data in groups.items():
+            attr_values = []
+            attr_json = {}
+            if len(group_data) > 1:
+                group_data.sort(key=lambda x: x[0][2])
+            for (_, _, _, felem_code, attr_code, _), attr_value in group_data:
+                if felem_code == "USAGE_TYPE":
+                    usage_type = attr_value
+                elif felem_code not in ("USED_FROM_DT", "USED_THRU_DT"):
+                    attr_values.append(str(attr_value))
+                    attr_json[attr_code] = attr_value
+            yield {
+                "SEGMENT": f"{segment}-{i}" if i else segment,
+                "ATTRIBUTE": attribute,
+                "USAGE_TYPE": usage_type,
+                "ATTR_VALUE": " ".join(attr_values),
+                "ATTR_JSON": attr_json,
+            }
+
+    def features(self, json_string):
+        """Yield the (FTYPE_CODE, ATTR_VALUE) of each feature parse() returns, for counting features.
+
+        Only the attributes are grouped, ATTR_VALUE is built just for RECORD_TYPE features and is
+        None for the rest.
+        """
+        json_data = orjson.loads(json_string)
+        groups = {}
+        for attribute, attr_value in json_data.items():
+            if not attr_value:
+                continue
+            if isinstance(attr_value, list):
+                i = 0
+                for child_data in attr_value:
+                    i += 1
+                    for record_attribute, child_value in child_data.items():
+                        if child_value:
+                            key_data = self.resolve_key(record_attribute)
+                            groups.setdefault((attribute, i, key_data[0], key_data[1]), []).append(
+                                (key_data, child_value)
+                            )
+            else:
+                key_data = self.resolve_key(attribute)
+                groups.setdefault(("ROOT", 0, key_data[0], key_data[1]), []).append((key_data, attr_value))
+
+        for group_data in groups.values():
+            if len(group_data) > 1:
+                group_data.sort(key=lambda x: x[0][2])
+            # Like parse(), a group takes its FTYPE_CODE from its attribute with the highest ATTR_ID
+            ftype_code = group_data[-1][0][5]
+            if not ftype_code:
+                continue
+            if ftype_code != "RECORD_TYPE":
+                yield ftype_code, None
+                continue
+            yield ftype_code, " ".join(
+                str(attr_value)
+                for key_data, attr_value in group_data
+                if key_data[3] not in ("USAGE_TYPE", "USED_FROM_DT", "USED_THRU_DT")
+            )
+
+    def _resolve_key(self, key):
+        """Resolve a record key to its (attribute, usage label, ATTR_ID, FELEM_CODE, ATTR_CODE, FTYPE_CODE)."""
+        attr_template = self.resolve_attribute(key.upper())
+        return (
+            intern_code(attr_template.get("FTYPE_CODE") or attr_template.get("ATTR_CODE")),
+            intern_code(attr_template.get("USAGE_TYPE", "")),
+            attr_template.get("ATTR_ID"),
+            intern_code(attr_template.get("FELEM_CODE")),
+            intern_code(attr_template.get("ATTR_CODE")),
+            intern_code(attr_template.get("FTYPE_CODE")),
+        )
+
+    def _resolve_attribute(self, attr_name):
+        """Resolve an attribute name, which may carry a usage label, to a shared read-only config template."""
         attr_data = {"ATTR_ID": 9999, "ATTR_CODE": attr_name, "ATTR_CLASS": "PAYLOAD"}
         if attr_name in self.attr_lookup:
-            attr_data = self.attr_lookup[attr_name].copy()
+            attr_data = dict(self.attr_lookup[attr_name])
         elif "_" in attr_name:
             possible_label = attr_name[0 : attr_name.find("_")]
             possible_attr_name = attr_name[attr_name.find("_") + 1 :]
             if possible_attr_name in self.attr_lookup:
-                attr_data = self.attr_lookup[possible_attr_name].copy()
+                attr_data = dict(self.attr_lookup[possible_attr_name])
                 attr_data["USAGE_TYPE"] = possible_label
             else:
                 possible_label = attr_name[attr_name.rfind("_") + 1 :]
                 possible_attr_name = attr_name[0 : attr_name.rfind("_")]
                 if possible_attr_name in self.attr_lookup:
-                    attr_data = self.attr_lookup[possible_attr_name].copy()
+                    attr_data = dict(self.attr_lookup[possible_attr_name])
                     attr_data["USAGE_TYPE"] = possible_label
-        attr_data["ATTR_VALUE"] = attr_value
-        return attr_data
+        return MappingProxyType(attr_data)
+
+    def cache_info(self):
+        """Return hit/miss counters for the attribute and record key resolution caches."""
+        return {
+            "resolve_attribute": self.resolve_attribute.cache_info()._asdict(),
+            "resolve_key": self.resolve_key.cache_info()._asdict(),
+        }
+
+    def lookup_attribute(self, attr_name, attr_value):
+        """Look up attribute definition from config and return attribute data dict."""
+        return {**self.resolve_attribute(attr_name), "ATTR_VALUE": attr_value}
 
-    def update_grouping(self, segment_id, attr_data):
-        """Add attribute data to the appropriate segment group."""
-        if attr_data.get("FTYPE_CODE"):
-            attribute = attr_data.get("FTYPE_CODE")
+    def update_grouping(self, segment_id, attr_template, attr_value):
+        """Add an attribute's config template and value to the appropriate segment group."""
+        if attr_template.get("FTYPE_CODE"):
+            attribute = attr_template.get("FTYPE_CODE")
         else:
-            attribute = attr_data.get("ATTR_CODE")
-        segment_id += f"|{attribute}|{attr_data.get('USAGE_TYPE', '')}"
+            attribute = attr_template.get("ATTR_CODE")
+        segment_id += f"|{attribute}|{attr_template.get('USAGE_TYPE', '')}"
         if segment_id not in self.attr_groups:
-            self.attr_groups[segment_id] = [attr_data]
+            self.attr_groups[segment_id] = [(attr_template, attr_value)]
         else:
-            self.attr_groups[segment_id].append(attr_data)
+            self.attr_groups[segment_id].append((attr_template, attr_value))
@@ -0,0 +1,205 @@
+"""Counters of an extraction, merged across the ranges and shards of each source and reported at the end of a run."""
+
+import json
+import os
+import pstats
+import time
+from typing import Any
+
+from heavy_hitters import merge_summary, new_summary, top_counts
+from stage_timer import merge_stage_ns, stage_breakdown
+
+
+def new_stats(target_geos):
+    """Return zeroed counters for extracting the target geos from a source or range."""
+    return {
+        "source_cnt": 0,
+        "rtype_skip_cnt": 0,
+        "alpha_skip_cnt": 0,
+        "prefilter_skip_cnt": 0,
+        "byte_cnt": 0,
+        "target_cnts": {geo: 0 for geo in target_geos},
+        "stage_ns": {},
+        "invalid_country_log": {},
+        "queue_depths": {},
+    }
+
+
+def add_queue_depths(stats, queue_name, depth_total, depth_samples):
+    """Add samples of the depth of a --pipeline queue into stats."""
+    queue_depths = stats["queue_depths"].setdefault(queue_name, [0, 0])
+    queue_depths[0] += depth_total
+    queue_depths[1] += depth_samples
+
+
+def format_queue_depths(queue_depths, queue_depth):
+    """Return a one line summary of how full each --pipeline queue has been on average."""
+    return ", ".join(
+        f"{queue_name} queue {depth_total / max(depth_samples, 1):.1f} of {queue_depth} full"
+        for queue_name, (depth_total, depth_samples) in queue_depths.items()
+    )
+
+
+def merge_country_log(country_log, other_country_log):
+    """Add the counts of another invalid country log, such as a shard's, into country_log."""
+    for geo, other_summary in other_country_log.items():
+        if geo not in country_log:
+            country_log[geo] = new_summary(other_summary["capacity"])
+        merge_summary(country_log[geo], other_summary)
+
+
+def write_country_log(country_log_file, country_log):
+    """Write the most frequent values failing each geo's country check, with their counts, to a JSON file."""
+    with open(country_log_file, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                geo: {
+                    "rejected_cnt": summary["total"],
+                    "exact": summary["floor"] == 0,
+                    "values": top_counts(summary),
+                }
+                for geo, summary in country_log.items()
+            },
+            f,
+            indent=4,
+        )
+
+
+def merge_stats(source_stats, range_stats):
+    """Add the counts returned for a range into the per source stats."""
+    for count_name in ("source_cnt", "rtype_skip_cnt", "alpha_skip_cnt", "prefilter_skip_cnt", "byte_cnt"):
+        source_stats[count_name] += range_stats[count_name]
+    merge_stage_ns(source_stats["stage_ns"], range_stats["stage_ns"])
+    if "profile_file" in range_stats:
+        source_stats.setdefault("profile_files", []).append(range_stats["profile_file"])
+    for geo, target_cnt in range_stats["target_cnts"].items():
+        source_stats["target_cnts"][geo] += target_cnt
+    merge_country_log(source_stats["invalid_country_log"], range_stats["invalid_country_log"])
+    for queue_name, (depth_total, depth_samples) in range_stats["queue_depths"].items():
+        add_queue_depths(source_stats, queue_name, depth_total, depth_samples)
+
+
+def progress_rates(row_cnt, byte_cnt, options):
+    """Return the rows and bytes per second read since the run started, for the progress output."""
+    elapsed_secs = max(time.time() - options.start_time, 0.001)
+    return f"{row_cnt / elapsed_secs:,.0f} rows/sec, {byte_cnt / elapsed_secs / 1_048_576:,.1f} MB/sec"
+
+
+def print_summary(source_stats, source_status, target_files, checkpoint_files, options):
+    """Print the rows read and found for each source, and any partial output or checkpoint it left."""
+    max_geo_len = len(max(options.target_geos, key=len))
+    for source_code, stats in source_stats.items():
+        status = "" if source_status[source_code] == "Complete" else f" ({source_status[source_code]})"
+        print(f"\n{source_code} - {stats['source_cnt']:,} rows read{status}")
+        if options.prefilter:
+            print(f"\t{stats['prefilter_skip_cnt']:,} rows skipped by the prefilter")
+        if stats["queue_depths"]:
+            print(f"\t{format_queue_depths(stats['queue_depths'], options.queue_depth)}")
+        for geo, target_cnt in stats["target_cnts"].items():
+            print(f"\t{geo:<{max_geo_len}} - {target_cnt:,} rows found")
+            if os.path.exists(target_files[source_code][geo] + ".part"):
+                print(f"\t{'':<{max_geo_len}}   partial output left in {target_files[source_code][geo]}.part")
+        if source_code in checkpoint_files and os.path.exists(checkpoint_files[source_code]):
+            print(f"\tcheckpoint left in {checkpoint_files[source_code]}, run again with --resume to carry on")
+
+
+def write_country_logs(source_stats, options, alpha_extension):
+    """Write the invalid country logs of the run and return the log merged across its sources."""
+    invalid_country_log: dict[str, dict[str, Any]] = {}
+    for stats in source_stats.values():
+        merge_country_log(invalid_country_log, stats["invalid_country_log"])
+    if invalid_country_log:
+        # Each source's log is written next to its outputs, unless all of them are wanted in one file
+        country_logs = {options.country_log: invalid_country_log} if options.country_log else {}
+        for source_code, stats in source_stats.items():
+            if stats["invalid_country_log"] and not options.country_log:
+                country_file = f"{options.config.output_path}/{source_code}{alpha_extension}.invalid_countries.json"
+                country_logs[country_file] = stats["invalid_country_log"]
+        print()
+        # Shards are merged as they finish, so the geos are listed in target geo order rather than merge order
+        for country_log_file, country_log in country_logs.items():
+            write_country_log(
+                country_log_file, {geo: country_log[geo] for geo in options.target_geos if geo in country_log}
+            )
+            print(f"Invalid country log written to {country_log_file}")
+        max_geo_len = len(max(options.target_geos, key=len))
+        for geo in options.target_geos:
+            if geo in invalid_country_log:
+                print(f"\t{geo:<{max_geo_len}} - {invalid_country_log[geo]['total']:,} failed the country check")
+        print()
+    return invalid_country_log
+
+
+def print_profile(source_stats, invalid_country_log, elapsed_secs, options, profiler):
+    """Print the time spent in each stage and the matches per geo, merging any cProfile stats into one pstats file."""
+    row_cnt = sum(stats["source_cnt"] for stats in source_stats.values())
+    byte_cnt = sum(stats["byte_cnt"] for stats in source_stats.values())
+    stage_ns: dict[str, int] = {}
+    for stats in source_stats.values():
+        merge_stage_ns(stage_ns, stats["stage_ns"])
+    workers_note = f", summed across {options.workers} workers" if options.workers > 1 else ""
+    print(f"\nProfile - {row_cnt:,} rows in {elapsed_secs:,.1f} seconds, {progress_rates(row_cnt, byte_cnt, options)}")
+    print("-" * 19)
+    print(f"\nTime per stage{workers_note}")
+    for stage, stage_secs, percent in stage_breakdown(stage_ns):
+        print(f"\t{stage:<10} {stage_secs:>10,.2f} s {percent:>6.1f}%")
+    print("\nRows per geo")
+    max_geo_len = len(max(next(iter(source_stats.values()))["target_cnts"], key=len))
+    for geo in next(iter(source_stats.values()))["target_cnts"]:
+        found_cnt = sum(stats["target_cnts"][geo] for stats in source_stats.values())
+        rejected_cnt = invalid_country_log[geo]["total"] if geo in invalid_country_log else 0
+        print(f"\t{geo:<{max_geo_len}} - {found_cnt:,} found, {rejected_cnt:,} failed the country check")
+
+    if profiler:
+        profile_stats = pstats.Stats(profiler)
+        for stats in source_stats.values():
+            for profile_file in stats.get("profile_files", []):
+                profile_stats.add(profile_file)
+                os.remove(profile_file)
+        profile_stats.dump_stats(options.profile)
+        print(f"\ncProfile stats written to {options.profile}, top functions by cumulative time:")
+        profile_stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(15)
+
+
+def write_stats_json(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    stats_file, source_stats, source_status, invalid_country_log, proc_status, elapsed_secs, options
+):
+    """Write the counts, rates and stage times of the run to a JSON file."""
+    run_stats: dict[str, Any] = {
+        "status": proc_status,
+        "start_time": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(options.start_time)),
+        "elapsed_secs": round(elapsed_secs, 3),
+        "options": {
+            "source_file": options.source_file,
+            "target_geos": options.target_geos,
+            "workers": options.workers,
+            "alpha_filter": options.alpha_filter,
+            "prefilter": options.prefilter,
+            "index": options.index,
+            "compress": options.compress,
+            "pipeline": options.pipeline,
+        },
+        "sources": {},
+        "invalid_country_cnts": {geo: summary["total"] for geo, summary in invalid_country_log.items()},
+    }
+    for source_code, stats in source_stats.items():
+        run_stats["sources"][source_code] = {
+            "status": source_status[source_code],
+            "rows_read": stats["source_cnt"],
+            "bytes_read": stats["byte_cnt"],
+            "rtype_skip_cnt": stats["rtype_skip_cnt"],
+            "alpha_skip_cnt": stats["alpha_skip_cnt"],
+            "prefilter_skip_cnt": stats["prefilter_skip_cnt"],
+            "target_cnts": stats["target_cnts"],
+            "stage_secs": {stage: round(stage_secs, 6) for stage, stage_secs, _ in stage_breakdown(stats["stage_ns"])},
+            "mean_queue_depths": {
+                queue_name: round(depth_total / max(depth_samples, 1), 2)
+                for queue_name, (depth_total, depth_samples) in stats["queue_depths"].items()
+            },
+        }
+    row_cnt = sum(stats["source_cnt"] for stats in source_stats.values())
+    byte_cnt = sum(stats["byte_cnt"] for stats in source_stats.values())
+    run_stats["rows_per_sec"] = round(row_cnt / max(elapsed_secs, 0.001), 1)
+    run_stats["bytes_per_sec"] = round(byte_cnt / max(elapsed_secs, 0.001), 1)
+    with open(stats_file, "w", encoding="utf-8") as f:
+        json.dump(run_stats, f, indent=4)
@@ -0,0 +1,286 @@
+"""Extraction of sources in shards across a process pool, merging each shard into its source's target files."""
+
+import multiprocessing
+import os
+import signal
+import time
+from typing import Any
+
+from checkpoint import checkpoint_merge, remove_checkpoints, source_checkpoint
+from geo_index import GeoIndex
+from run_stats import format_queue_depths, merge_stats, progress_rates
+from stage_timer import format_stage_times
+from stream_io import OutputWriter, detect_compression, split_source
+
+
+def init_worker():
+    """Leave keyboard interrupts to the parent process."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def remove_files(*file_names):
+    """Delete the files, and any unfinished write of them, that exist."""
+    for file_name in file_names:
+        for path in (file_name, file_name + ".part"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def plan_shards(source_files, options, source_status, indexed_sources):
+    """Split the sources into (start, end, size) shards, sharing the workers by source size.
+
+    Compressed sources cannot be split into byte ranges so they are read whole by a single worker,
+    as are sources extracted from a current index.
+    """
+    source_sizes = {}
+    for source_code, source_file in source_files.items():
+        try:
+            source_sizes[source_code] = os.path.getsize(source_file)
+        except OSError as err:
+            print(f"\nERROR: {err}", flush=True)
+            source_status[source_code] = "Errored out!"
+    total_size = sum(source_sizes.values()) or 1
+    shard_plan = {}
+    for source_code, source_size in source_sizes.items():
+        shard_cnt = max(1, round(options.workers * source_size / total_size))
+        shard_plan[source_code] = [(0, None, source_size)]
+        if shard_cnt > 1 and source_code not in indexed_sources and not detect_compression(source_files[source_code]):
+            shards = split_source(source_files[source_code], shard_cnt)
+            if len(shards) > 1:
+                shard_plan[source_code] = [(start, end, end - start) for start, end in shards]
+    return shard_plan
+
+
+def merge_index_shards(index_file, source_file, shard_cnt, line_cnt):
+    """Combine the indexes written for each shard of a source, in shard order, into its index."""
+    geo_index = GeoIndex(index_file)
+    geo_index.create()
+    try:
+        for shard_idx in range(shard_cnt):
+            geo_index.add_index(f"{index_file}.shard{shard_idx}")
+        geo_index.commit(source_file, line_cnt)
+    finally:
+        geo_index.close()
+
+
+class SourceShards:  # pylint: disable=too-many-instance-attributes
+    """The shards of one source and the target writers they are merged into as they finish.
+
+    Shards are merged as soon as they finish, or in shard order with --ordered. A source with a
+    checkpoint file records each merge there, so --resume only extracts the shards not yet merged.
+    """
+
+    def __init__(self, source_file, shards, target_files, options, checkpoint_file=None):
+        self.source_file = source_file
+        self.shards = shards
+        self.target_files = target_files
+        self.options = options
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint_data: dict[str, Any] | None = None
+        self.target_writers = {
+            geo: OutputWriter(file_name, options.flush_size, options.compress)
+            for geo, file_name in target_files.items()
+        }
+        self.merged: set[int] = set()
+        self.pending: dict[int, dict[str, Any]] = {}
+        self.next_shard_idx = 0
+        self.done_cnt = 0
+
+    def load_checkpoint(self):
+        """Save a new checkpoint or, with --resume, pick up the shards and outputs of the last one.
+
+        Returns the stats of the shards already merged, raising OSError or ValueError if the
+        checkpoint cannot be resumed.
+        """
+        self.checkpoint_data = source_checkpoint(
+            self.checkpoint_file,
+            self.source_file,
+            self.target_files,
+            [[start, end] for start, end, _ in self.shards],
+            self.options,
+        )
+        # A resumed source keeps the shards it was checkpointed with
+        self.shards = [
+            (start, end, (os.path.getsize(self.source_file) if end is None else end) - start)
+            for start, end in self.checkpoint_data["shards"]
+        ]
+        # A run interrupted just after merging a shard may have left its files behind
+        for shard_idx in self.checkpoint_data["merged"]:
+            remove_files(*(f"{file_name}.shard{shard_idx}" for file_name in self.target_files.values()))
+        for geo, (size, line_cnt) in self.checkpoint_data["outputs"].items():
+            self.target_writers[geo].resume(size, line_cnt)
+        self.merged = set(self.checkpoint_data["merged"])
+        self.done_cnt = len(self.merged)
+        self.advance()
+        return self.checkpoint_data["stats"]
+
+    def advance(self):
+        """Move the next shard to merge with --ordered past those already merged."""
+        while self.next_shard_idx in self.merged:
+            self.next_shard_idx += 1
+
+    def unmerged_shards(self):
+        """Yield the index, start, end and size of each shard still to be extracted."""
+        for shard_idx, (start, end, size) in enumerate(self.shards):
+            if shard_idx not in self.merged:
+                yield shard_idx, start, end, size
+
+    @property
+    def total_size(self):
+        """Return the bytes of the source covered by its shards."""
+        return sum(shard[2] for shard in self.shards)
+
+    @property
+    def done(self):
+        """Return whether every shard has finished."""
+        return self.done_cnt == len(self.shards)
+
+    def add_shard(self, shard_stats, errored):
+        """Take a finished shard, appending it and any shards it held back to the target files.
+
+        The shards of an errored source are dropped, or with a checkpoint left for --resume.
+        """
+        self.done_cnt += 1
+        self.pending[shard_stats["shard_idx"]] = shard_stats
+        while self.pending:
+            shard_idx = self.next_shard_idx if self.options.ordered else next(iter(self.pending))
+            if shard_idx not in self.pending:
+                break
+            shard_stats = self.pending.pop(shard_idx)
+            self.merged.add(shard_idx)
+            self.advance()
+            if self.checkpoint_data and errored:
+                continue  # leave the shard's files and checkpoint for --resume
+            for geo, shard_file in shard_stats["shard_files"].items():
+                if not errored and shard_stats["target_cnts"][geo] > 0:
+                    self.target_writers[geo].append_file(shard_file, shard_stats["target_cnts"][geo])
+            if self.checkpoint_data:
+                checkpoint_merge(
+                    self.checkpoint_file, self.checkpoint_data, shard_idx, shard_stats, self.target_writers
+                )
+            remove_files(*shard_stats["shard_files"].values())
+
+    def commit(self):
+        """Publish the target files and remove the source's checkpoints."""
+        for target_writer in self.target_writers.values():
+            target_writer.commit()
+        if self.checkpoint_data:
+            remove_checkpoints(self.checkpoint_file)
+
+    def close(self):
+        """Close the target writers, discarding any uncommitted output."""
+        for target_writer in self.target_writers.values():
+            target_writer.close()
+
+
+def print_shard_progress(source_code, source_shards, stats, options):
+    """Print the rows read and found so far for a source, after one of its shards finished."""
+    elapsed_mins = round((time.time() - options.start_time) / 60, 1)
+    print(
+        f"\n{source_code} - {source_shards.done_cnt} of {len(source_shards.shards)} shard(s) done, "
+        f"{stats['source_cnt']:,} rows read after {elapsed_mins} minutes, "
+        f"{progress_rates(stats['source_cnt'], stats['byte_cnt'], options)}"
+    )
+    if options.profile is not None:
+        print(f"\t{format_stage_times(stats['stage_ns'])}")
+    if stats["queue_depths"]:
+        print(f"\t{format_queue_depths(stats['queue_depths'], options.queue_depth)}")
+    max_geo_len = len(max(stats["target_cnts"], key=len))
+    for geo, target_cnt in stats["target_cnts"].items():
+        print(f"\t{geo:<{max_geo_len}} - {target_cnt:,} rows found")
+
+
+def extract_shards(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    source_files,
+    target_files,
+    options,
+    source_stats,
+    source_status,
+    index_files,
+    checkpoint_files,
+    indexed_sources,
+    extract_shard,
+):
+    """Extract the sources in shards scheduled, largest first, across a pool running extract_shard.
+
+    The indexed sources are read whole from their index, other sources with an index file build it
+    in shards that are combined once the source is complete.
+    """
+    sources = {}
+    try:
+        for source_code, shards in plan_shards(source_files, options, source_status, indexed_sources).items():
+            sources[source_code] = SourceShards(
+                source_files[source_code],
+                shards,
+                target_files[source_code],
+                options,
+                checkpoint_files.get(source_code),
+            )
+            if source_code in checkpoint_files:
+                try:
+                    merge_stats(source_stats[source_code], sources[source_code].load_checkpoint())
+                except (OSError, ValueError) as err:
+                    print(f"\nERROR: {err}", flush=True)
+                    source_status[source_code] = "Errored out!"
+                    sources.pop(source_code).close()
+
+        shard_tasks = [
+            (
+                source_code,
+                source_files[source_code],
+                shard_idx,
+                len(source_shards.shards),
+                start,
+                end,
+                target_files[source_code],
+                options,
+                index_files.get(source_code),
+                source_code in indexed_sources,
+                checkpoint_files.get(source_code),
+                options.resume,
+            )
+            for source_code, source_shards in sources.items()
+            for shard_idx, start, end, _ in source_shards.unmerged_shards()
+        ]
+        shard_tasks.sort(key=lambda x: sources[x[0]].shards[x[2]][2], reverse=True)
+        for source_code, source_shards in sorted(sources.items(), key=lambda x: x[1].total_size, reverse=True):
+            if source_code in indexed_sources:
+                print(f"\nProcessing {source_files[source_code]} from {index_files[source_code]}")
+            elif source_shards.merged:
+                print(
+                    f"\nResuming {source_files[source_code]} with {len(source_shards.merged)} of "
+                    f"{len(source_shards.shards)} shard(s) done"
+                )
+            else:
+                print(f"\nProcessing {source_files[source_code]} in {len(source_shards.shards)} shard(s)")
+            source_status[source_code] = "Processing"
+            # Interrupted after its last shard was merged, the source only has to be committed
+            if source_shards.done:
+                source_shards.commit()
+                source_status[source_code] = "Complete"
+
+        with multiprocessing.Pool(options.workers, initializer=init_worker) as pool:
+            for range_stats in pool.imap_unordered(extract_shard, shard_tasks):
+                source_code = range_stats["source_code"]
+                source_shards = sources[source_code]
+                merge_stats(source_stats[source_code], range_stats)
+                if "error" in range_stats:
+                    print(f"\nERROR: {range_stats['error']}", flush=True)
+                    source_status[source_code] = "Errored out!"
+                source_shards.add_shard(range_stats, source_status[source_code] != "Processing")
+                print_shard_progress(source_code, source_shards, source_stats[source_code], options)
+                if source_shards.done and source_status[source_code] == "Processing":
+                    source_shards.commit()
+                    if source_code in index_files and source_code not in indexed_sources and source_shards.done_cnt > 1:
+                        merge_index_shards(
+                            index_files[source_code],
+                            source_files[source_code],
+                            source_shards.done_cnt,
+                            source_stats[source_code]["source_cnt"],
+                        )
+                    source_status[source_code] = "Complete"
+    finally:
+        for source_code, source_shards in sources.items():
+            source_shards.close()
+            if source_code in index_files and source_code not in indexed_sources:
+                remove_files(*(f"{index_files[source_code]}.shard{idx}" for idx in range(len(source_shards.shards))))
@@ -0,0 +1,52 @@
+"""Low overhead timing of the stages each source line passes through."""
+
+import time
+
+STAGES = ("read", "prefilter", "parse", "index", "filter", "match", "write")
+
+
+class StageTimer:  # pylint: disable=too-few-public-methods
+    """Lap timer that charges the time since the previous lap to the stage named by each lap.
+
+    The per stage nanosecond totals are kept in a plain dict so they can be returned from pool
+    workers and merged across shards.
+    """
+
+    def __init__(self, stage_ns):
+        self.stage_ns = stage_ns
+        self.last_ns = time.perf_counter_ns()
+
+    def lap(self, stage):
+        """Charge the time since the previous lap to a stage."""
+        now_ns = time.perf_counter_ns()
+        self.stage_ns[stage] = self.stage_ns.get(stage, 0) + now_ns - self.last_ns
+        self.last_ns = now_ns
+
+
+def skip_lap(stage):  # pylint: disable=unused-argument
+    """Stand in for StageTimer.lap when the stages are not being timed."""
+
+
+def lap_function(stage_ns, enabled):
+    """Return the lap method of a new timer over stage_ns, or a no-op when timing is not enabled."""
+    return StageTimer(stage_ns).lap if enabled else skip_lap
+
+
+def merge_stage_ns(stage_ns, other_stage_ns):
+    """Add the stage totals of another timer, such as a shard's, into stage_ns."""
+    for stage, elapsed_ns in other_stage_ns.items():
+        stage_ns[stage] = stage_ns.get(stage, 0) + elapsed_ns
+
+
+def stage_breakdown(stage_ns):
+    """Return the (stage, seconds, percent of total) of each timed stage in pipeline order."""
+    total_ns = sum(stage_ns.values()) or 1
+    return [
+        (stage, stage_ns[stage] / 1e9, 100 * stage_ns[stage] / total_ns)
+        for stage in sorted(stage_ns, key=lambda x: STAGES.index(x) if x in STAGES else len(STAGES))
+    ]
+
+
+def format_stage_times(stage_ns):
+    """Return a one line summary of the share of time spent in each stage."""
+    return ", ".join(f"{stage} {percent:.0f}%" for stage, _, percent in stage_breakdown(stage_ns))
@@ -0,0 +1,340 @@
+"""Streaming file helpers shared by the extraction and statistics scripts."""
+
+import bz2
+import gzip
+import io
+import os
+import queue
+import shutil
+import threading
+from typing import BinaryIO, Callable
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None  # type: ignore[assignment]
+
+DEFAULT_FLUSH_SIZE = 1_048_576
+COPY_CHUNK_SIZE = 4_194_304
+READ_BUFFER_SIZE = 4_194_304
+DEFAULT_QUEUE_DEPTH = 8
+
+COMPRESSION_EXTENSIONS = {"gz": ".gz", "bz2": ".bz2", "zst": ".zst"}
+COMPRESSION_MAGIC = {"gz": b"\x1f\x8b", "bz2": b"BZh", "zst": b"\x28\xb5\x2f\xfd"}
+
+
+def detect_compression(file_name):
+    """Return the compression of a file from its extension, or its magic bytes when the extension is unknown."""
+    for compression, extension in COMPRESSION_EXTENSIONS.items():
+        if file_name.endswith(extension):
+            return compression
+    with open(file_name, "rb") as f:
+        file_start = f.read(4)
+    for compression, magic in COMPRESSION_MAGIC.items():
+        if file_start.startswith(magic):
+            return compression
+    return None
+
+
+def require_zstandard():
+    """Raise a helpful error when zstd support is needed but the zstandard package is not installed."""
+    if zstandard is None:
+        raise OSError("zstd compression requires the zstandard package, pip install zstandard")
+
+
+def open_source(file_name, compression=None):
+    """Open a source file for binary reading, transparently decompressing it with large buffered reads."""
+    raw_handle = open(file_name, "rb", buffering=READ_BUFFER_SIZE)  # pylint: disable=consider-using-with
+    if compression == "gz":
+        return io.BufferedReader(gzip.GzipFile(fileobj=raw_handle), READ_BUFFER_SIZE)
+    if compression == "bz2":
+        return io.BufferedReader(bz2.BZ2File(raw_handle), READ_BUFFER_SIZE)
+    if compression == "zst":
+        require_zstandard()
+        return io.BufferedReader(
+            zstandard.ZstdDecompressor().stream_reader(raw_handle, read_across_frames=True), READ_BUFFER_SIZE
+        )
+    return raw_handle
+
+
+def seek_source(sourcef, position, current=0):
+    """Move an open source file to a byte position, reading forward from current through streams that cannot seek."""
+    if sourcef.seekable():
+        sourcef.seek(position)
+        return
+    if position < current:
+        raise io.UnsupportedOperation(f"cannot seek back to {position:,} in a compressed stream at {current:,}")
+    skip_size = position - current
+    while skip_size > 0:
+        chunk = sourcef.read(min(skip_size, COPY_CHUNK_SIZE))
+        if not chunk:
+            break
+        skip_size -= len(chunk)
+
+
+class ChunkReader:  # pylint: disable=too-many-instance-attributes
+    """Background thread reading a source file ahead in large newline aligned chunks through a bounded queue.
+
+    Reading, and decompressing, then overlaps the parsing and matching of the lines already read,
+    and the queue bounds how far ahead it gets. The queue depth is sampled each time a chunk is
+    taken: a queue that is mostly full means reading is waiting on the lines to be processed,
+    one that is mostly empty means processing is waiting on reads.
+    """
+
+    def __init__(self, sourcef, size=None, chunk_size=READ_BUFFER_SIZE, depth=DEFAULT_QUEUE_DEPTH):
+        self.sourcef = sourcef
+        self.size = size
+        self.chunk_size = chunk_size
+        self.queue: queue.Queue[bytes | None] = queue.Queue(depth)
+        self.depth_total = 0
+        self.depth_samples = 0
+        self.error: BaseException | None = None
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Read chunks ending at a newline until the end of the file, or until size bytes have been read."""
+        try:
+            read_cnt = 0
+            remainder = b""
+            while not self.stopped:
+                chunk = self.sourcef.read(self.chunk_size)
+                if not chunk:
+                    if remainder:
+                        self.put(remainder)
+                    break
+                chunk = remainder + chunk
+                chunk_end = chunk.rfind(b"\n") + 1
+                remainder = chunk[chunk_end:]
+                if chunk_end:
+                    read_cnt += chunk_end
+                    self.put(chunk[:chunk_end])
+                    if self.size is not None and read_cnt >= self.size:
+                        break
+        except Exception as err:
+            self.error = err
+        finally:
+            self.put(None)
+
+    def put(self, chunk):
+        """Queue a chunk, waiting for room unless the reader has been stopped."""
+        while not self.stopped:
+            try:
+                self.queue.put(chunk, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def lines(self):
+        """Yield the lines of each chunk as it is taken from the queue, raising any error the reader hit."""
+        while True:
+            self.depth_total += self.queue.qsize()
+            self.depth_samples += 1
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            yield from io.BytesIO(chunk)
+        if self.error:
+            raise self.error
+
+    def close(self):
+        """Stop the reader thread and wait for it, so the source file can be closed."""
+        self.stopped = True
+        self.thread.join()
+
+
+class WriteQueue:
+    """Background thread carrying out queued writes, such as OutputWriter flushes, in order.
+
+    Writing, and compressing, then overlaps the reading and matching of further lines, and the
+    bounded queue holds back the writers when writing falls behind. The queue depth is sampled at
+    each put: a queue that is mostly full means writing is the bottleneck. An error raised by a
+    write is raised again by the next put or drain, and the writes queued after it are skipped.
+    """
+
+    def __init__(self, depth=DEFAULT_QUEUE_DEPTH):
+        self.queue: queue.Queue[Callable[[], None] | None] = queue.Queue(depth)
+        self.depth_total = 0
+        self.depth_samples = 0
+        self.error: BaseException | None = None
+        self.failed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Carry out the queued writes until the queue is closed."""
+        while True:
+            write = self.queue.get()
+            if write is None:
+                self.queue.task_done()
+                return
+            if not self.failed:
+                try:
+                    write()
+                except Exception as err:
+                    self.error = err
+                    self.failed = True
+            self.queue.task_done()
+
+    def raise_error(self):
+        """Raise the error a write hit, once."""
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+
+    def put(self, write):
+        """Queue a write, waiting while the queue is full."""
+        self.raise_error()
+        self.depth_total += self.queue.qsize()
+        self.depth_samples += 1
+        self.queue.put(write)
+
+    def drain(self):
+        """Wait until every queued write has been carried out."""
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        """Carry out the queued writes and stop the writer thread."""
+        self.queue.put(None)
+        self.thread.join()
+        self.raise_error()
+
+
+def split_source(file_name, shard_cnt):
+    """Split a source file into newline aligned (start, end) byte ranges."""
+    file_size = os.path.getsize(file_name)
+    boundaries = [0]
+    with open(file_name, "rb") as f:
+        for i in range(1, shard_cnt):
+            f.seek(max(file_size * i // shard_cnt, boundaries[-1]))
+            f.readline()
+            boundaries.append(f.tell())
+    boundaries.append(file_size)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+
+
+def open_compressor(raw_handle, compression):
+    """Start a compressed stream on an open binary file, leaving the file open when the stream is closed."""
+    if compression == "gz":
+        return gzip.GzipFile(fileobj=raw_handle, mode="wb")
+    if compression == "bz2":
+        return bz2.BZ2File(raw_handle, "wb")
+    require_zstandard()
+    return zstandard.ZstdCompressor().stream_writer(raw_handle, closefd=False)
+
+
+class OutputWriter:  # pylint: disable=too-many-instance-attributes
+    """Buffered, append-as-you-go writer that publishes its file with an atomic rename.
+
+    With a compression each run of flushed lines is written as its own compressed member, which
+    gzip, bz2 and zstd readers all decode as one stream, so already compressed files such as
+    shards can be appended without recompressing them. Given a write queue the flushes are
+    written, and compressed, by its background thread.
+    """
+
+    def __init__(self, file_name, flush_size=DEFAULT_FLUSH_SIZE, compression=None, write_queue=None):
+        self.file_name = file_name
+        self.temp_file_name = file_name + ".part"
+        self.flush_size = flush_size
+        self.compression = compression
+        self.write_queue = write_queue
+        self.line_cnt = 0
+        self.buffer: list[bytes] = []
+        self.buffer_size = 0
+        self.handle: BinaryIO | None = None
+        self.compressor = None
+
+    def open(self) -> BinaryIO:
+        """Open the temporary file, done lazily so targets without matches leave no file behind."""
+        if not self.handle:
+            self.handle = open(self.temp_file_name, "wb")  # pylint: disable=consider-using-with
+        return self.handle
+
+    def write(self, line):
+        """Buffer a line, flushing to the temporary file once flush_size is reached."""
+        self.buffer.append(line)
+        self.buffer_size += len(line)
+        self.line_cnt += 1
+        if self.buffer_size >= self.flush_size:
+            self.flush()
+
+    def append_file(self, file_name, line_cnt):
+        """Append the contents of an already written file, such as a shard of the target."""
+        self.flush()
+        self.end_member()
+        handle = self.open()
+        with open(file_name, "rb") as f:
+            shutil.copyfileobj(f, handle, COPY_CHUNK_SIZE)
+        self.line_cnt += line_cnt
+
+    def flush(self):
+        """Append buffered lines to the temporary file, handing them to the write queue if there is one."""
+        if not self.buffer:
+            return
+        lines = self.buffer
+        self.buffer = []
+        self.buffer_size = 0
+        if self.write_queue:
+            self.write_queue.put(lambda: self.write_lines(lines))
+        else:
+            self.write_lines(lines)
+
+    def write_lines(self, lines):
+        """Append lines to the temporary file, compressing them if required."""
+        handle = self.open()
+        if self.compression:
+            if not self.compressor:
+                self.compressor = open_compressor(handle, self.compression)
+            self.compressor.write(b"".join(lines))
+        else:
+            handle.writelines(lines)
+
+    def end_member(self):
+        """Finish the current compressed member so the file can be appended to or closed."""
+        if self.write_queue:
+            self.write_queue.drain()
+        if self.compressor:
+            self.compressor.close()
+            self.compressor = None
+
+    def checkpoint(self):
+        """Write out every buffered line and return the (size, line count) the temporary file can be resumed from."""
+        self.flush()
+        self.end_member()
+        if not self.handle:
+            return 0, self.line_cnt
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+        return self.handle.tell(), self.line_cnt
+
+    def resume(self, size, line_cnt):
+        """Continue the temporary file from a checkpoint, truncating whatever was written after it.
+
+        Raises ValueError if the temporary file is shorter than at the checkpoint, as when another run
+        has replaced or committed it since.
+        """
+        self.line_cnt = line_cnt
+        if size:
+            if not os.path.exists(self.temp_file_name) or os.path.getsize(self.temp_file_name) < size:
+                raise ValueError(f"{self.temp_file_name} changed since it was checkpointed, run again without --resume")
+            self.handle = open(self.temp_file_name, "r+b")  # pylint: disable=consider-using-with
+            self.handle.truncate(size)
+            self.handle.seek(size)
+        elif os.path.exists(self.temp_file_name):
+            os.remove(self.temp_file_name)
+
+    def close(self):
+        """Flush any buffered lines and close the temporary file."""
+        self.flush()
+        self.end_member()
+        if self.handle:
+            self.handle.close()
+            self.handle = None
+
+    def commit(self):
+        """Close the temporary file and rename it over the target file."""
+        self.close()
+        if self.line_cnt > 0:
+            os.replace(self.temp_file_name, self.file_name)
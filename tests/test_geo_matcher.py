@@ -0,0 +1,178 @@
+"""Tests of the compiled GeoMatcher and the GeoPrefilter against the per geo match functions."""
+
+import json
+import random
+
+import pytest
+
+from geo_extractor import GeoConfig, GeoExtractor, load_config, normalize_address
+from geo_matcher import (
+    MATCH_FUNCTIONS,
+    GeoMatcher,
+    GeoPrefilter,
+    country_matches,
+    register_match_function,
+)
+
+NOISE_VALUES = (
+    "paris",
+    "springfield",
+    "new london",
+    "london road",
+    "east london",
+    "las vegas blvd",
+    "st",
+    "w10",
+    "sw1a",
+    "nw",
+    "москва",
+    "zürich",
+    "são paulo",
+    "1",
+    "",
+)
+
+
+@register_match_function
+def postal_code_only(geo_config, addr_data):
+    """Match an address on its postal code alone, a geo function the GeoMatcher does not compile."""
+    return any(addr_data["ADDR_POSTAL_CODE"].startswith(s) for s in geo_config["postal_codes"])
+
+
+def extended_config():
+    """Return the configured geos plus geos that only set states, only set postal codes or have several cities."""
+    config = load_config()
+    extra_geos = GeoConfig(
+        {
+            "output_path": "",
+            "source_files": {},
+            "target_geos": {
+                "nevada": {
+                    "countries": ["us", "usa"],
+                    "states": ["nv", "nevada"],
+                    "cities": [],
+                    "function": "pure_config",
+                },
+                "soho": {
+                    "countries": ["uk", "gb"],
+                    "states": [],
+                    "cities": [],
+                    "postal_codes": ["w1d", "w1f"],
+                    "function": "pure_config",
+                },
+                "monaco": {
+                    "countries": ["mc", "monaco"],
+                    "states": [],
+                    "cities": ["monaco", "monte carlo"],
+                    "function": "city_or_country",
+                },
+            },
+        }
+    )
+    config.geos.update(extra_geos.geos)
+    return config
+
+
+def geo_values(geos):
+    """Return every city, state, country and postal code configured for the geos."""
+    return sorted(
+        {
+            value
+            for geo_config in geos.values()
+            for role in ("cities", "states", "countries", "postal_codes")
+            for value in geo_config.get(role, [])
+        }
+    )
+
+
+def random_value(rnd, values):
+    """Return one or two configured or noise values, in a random case and possibly with a suffix."""
+    value = " ".join(rnd.choice(values) for _ in range(rnd.choice((1, 1, 1, 2))))
+    value = rnd.choice((value, value.upper(), value.title(), f" {value} "))
+    if rnd.random() < 0.2:
+        value += rnd.choice(("1", " 1aa", "-x", ","))
+    return value
+
+
+def random_address(rnd, values):
+    """Return a raw address with ADDR_FULL or with parsed fields, any of which may be missing."""
+    if rnd.random() < 0.4:
+        addr_data = {"ADDR_FULL": ", ".join(random_value(rnd, values) for _ in range(rnd.randint(1, 4)))}
+        if rnd.random() < 0.3:
+            addr_data["ADDR_COUNTRY"] = random_value(rnd, values)
+        return addr_data
+    return {
+        addr_key: random_value(rnd, values)
+        for addr_key in ("ADDR_CITY", "ADDR_STATE", "ADDR_POSTAL_CODE", "ADDR_COUNTRY")
+        if rnd.random() < 0.8
+    }
+
+
+def reference_match(geos, target_geos, addr_data):
+    """Return the geos an address matches and those failing the country check, calling each geo's function."""
+    matched_geos = []
+    rejected_geos = []
+    for geo in target_geos:
+        geo_config = geos[geo]
+        if MATCH_FUNCTIONS[geo_config["function"]](geo_config, addr_data):
+            (matched_geos if country_matches(geo_config, addr_data) else rejected_geos).append(geo)
+    return matched_geos, rejected_geos
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_match_equals_match_functions(seed):
+    """GeoMatcher.match gives the results of pure_config, city_or_country and country_matches."""
+    rnd = random.Random(seed)
+    geos = extended_config().geos
+    values = geo_values(geos) + list(NOISE_VALUES)
+    target_geos = rnd.sample(sorted(geos), rnd.randint(1, len(geos)))
+    geo_matcher = GeoMatcher(geos, target_geos)
+    match_cnt = 0
+    for _ in range(2000):
+        addr_data = normalize_address(random_address(rnd, values))
+        expected = reference_match(geos, target_geos, addr_data)
+        assert geo_matcher.match(addr_data) == expected, addr_data
+        match_cnt += bool(expected[0] or expected[1])
+    assert match_cnt > 0
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_prefilter_has_no_false_negatives(seed):
+    """Every line the prefilter skips has no address that matches, or fails the country check of, a target geo."""
+    rnd = random.Random(seed)
+    config = extended_config()
+    values = geo_values(config.geos) + list(NOISE_VALUES)
+    target_geos = rnd.sample(sorted(config.geos), rnd.randint(1, len(config.geos)))
+    geo_prefilter = GeoPrefilter(config.geos, target_geos)
+    extractor = GeoExtractor(config, target_geos)
+    skipped_cnt = 0
+    for record_id in range(1000):
+        record = {"DATA_SOURCE": "TEST", "RECORD_ID": str(record_id), "RECORD_TYPE": "PERSON"}
+        label = rnd.choice(("", "", "BUSINESS_", "HOME_"))
+        record.update({label + addr_key: value for addr_key, value in random_address(rnd, values).items()})
+        line = json.dumps(record, ensure_ascii=rnd.random() < 0.2).encode() + b"\n"
+        if geo_prefilter.may_match(line):
+            continue
+        skipped_cnt += 1
+        for parsed_record in extractor.iter_records([line]):
+            for addr_data in parsed_record["addresses"]:
+                assert extractor.geo_matcher.match(addr_data) == ([], []), line
+    assert skipped_cnt > 0
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_match_batch_equals_match(seed):
+    """GeoMatcher.match_batch gives each address the results of match, in the same order."""
+    rnd = random.Random(seed)
+    geos = extended_config().geos
+    geos["westminster"] = {"countries": ["uk", "gb"], "postal_codes": ["sw1", "w1"], "function": "postal_code_only"}
+    values = geo_values(geos) + list(NOISE_VALUES)
+    target_geos = rnd.sample(sorted(geos), rnd.randint(1, len(geos)))
+    geo_matcher = GeoMatcher(geos, target_geos)
+    for batch_size in (0, 1, 2, 17, 256, 1000):
+        addresses = [normalize_address(random_address(rnd, values)) for _ in range(batch_size)]
+        results = [
+            (list(matched_geos), list(rejected_geos))
+            for matched_geos, rejected_geos in geo_matcher.match_batch(addresses)
+        ]
+        assert results == [geo_matcher.match(addr_data) for addr_data in addresses]
@@ -0,0 +1,88 @@
+"""Tests of the Space-Saving summaries kept for the invalid country log."""
+
+import random
+from collections import Counter
+
+import pytest
+
+from heavy_hitters import add_value, merge_summary, new_summary, top_counts
+
+
+def random_stream(rnd, length, value_cnt):
+    """Return a skewed stream of values, a few frequent ones and a long tail."""
+    return [f"v{int(value_cnt * rnd.random() ** 3)}" for _ in range(length)]
+
+
+def assert_bounds(summary, true_counts):
+    """Check a summary against the true counts of the values added to it."""
+    assert summary["total"] == sum(true_counts.values())
+    assert len(summary["counts"]) <= 2 * summary["capacity"]
+    for value, (count, error) in summary["counts"].items():
+        assert 0 <= error <= summary["floor"]
+        assert count - error <= true_counts[value] <= count, value
+    for value, true_count in true_counts.items():
+        if value not in summary["counts"]:
+            assert true_count <= summary["floor"], value
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_add_value_bounds(seed):
+    """Counts bound the true counts, and untracked values were added at most floor times."""
+    rnd = random.Random(seed)
+    capacity = rnd.choice((1, 3, 10))
+    summary = new_summary(capacity)
+    true_counts: Counter = Counter()
+    for value in random_stream(rnd, 5000, 200):
+        cnt = rnd.choice((1, 1, 1, 2, 5))
+        add_value(summary, value, cnt)
+        true_counts[value] += cnt
+        assert summary["floor"] <= summary["total"] / capacity
+    assert_bounds(summary, true_counts)
+    assert summary["floor"] > 0
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_merge_summary_bounds(seed):
+    """Merging shard summaries, of any capacities, keeps the bounds for the whole stream."""
+    rnd = random.Random(seed)
+    true_counts: Counter = Counter()
+    merged = new_summary(10)
+    for _ in range(rnd.randint(1, 6)):
+        summary = new_summary(rnd.choice((3, 10, 20)))
+        for value in random_stream(rnd, rnd.randint(0, 2000), 100):
+            add_value(summary, value)
+            true_counts[value] += 1
+        merge_summary(merged, summary)
+        assert_bounds(merged, true_counts)
+    assert len(merged["counts"]) <= merged["capacity"]
+
+
+def test_exact_until_pruned():
+    """Counts stay exact until there are more than twice capacity values."""
+    summary = new_summary(3)
+    for cnt, value in enumerate(("a", "b", "c", "d", "e", "f"), 1):
+        add_value(summary, value, cnt)
+    assert summary["floor"] == 0
+    assert len(summary["counts"]) == 6
+    assert top_counts(summary, 2) == [{"value": "f", "count": 6, "error": 0}, {"value": "e", "count": 5, "error": 0}]
+
+
+def test_prune_keeps_capacity_highest():
+    """Going over twice capacity values keeps the capacity highest counts and raises the floor."""
+    summary = new_summary(3)
+    for cnt, value in enumerate(("a", "b", "c", "d", "e", "f"), 1):
+        add_value(summary, value, cnt)
+    add_value(summary, "g")
+    assert summary["counts"] == {"f": [6, 0], "e": [5, 0], "d": [4, 0]}
+    assert summary["floor"] == 3
+    assert summary["total"] == 22
+    add_value(summary, "a")
+    assert summary["counts"]["a"] == [4, 3]
+
+
+def test_merge_charges_the_other_floor():
+    """A value counted by only one summary is charged the other's floor as count and error."""
+    summary = {"capacity": 3, "total": 9, "floor": 2, "counts": {"a": [5, 0], "b": [4, 2]}}
+    other_summary = {"capacity": 3, "total": 4, "floor": 1, "counts": {"b": [2, 1], "c": [2, 0]}}
+    merge_summary(summary, other_summary)
+    assert summary == {"capacity": 3, "total": 13, "floor": 3, "counts": {"a": [6, 1], "b": [6, 3], "c": [4, 2]}}
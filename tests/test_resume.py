@@ -0,0 +1,108 @@
+"""Tests that a run interrupted and carried on with --resume writes the same files as an uninterrupted run."""
+
+import glob
+import json
+import os
+import random
+import sys
+
+import pytest
+
+import geo_extractor
+import shard_pool
+from geo_extractor import APP_PATH, GeoConfig, GeoExtractor, JSONWithComments
+
+RECORD_CNT = 10_000
+
+
+@pytest.fixture(name="config_data")
+def fixture_config_data(tmp_path):
+    """Return the configured geos with a generated source, half its addresses in them, as its only source file."""
+    with open(APP_PATH + "geo_extractor_config.json", encoding="utf-8") as f:
+        config_data = json.loads(f.read(), cls=JSONWithComments)
+    geo_configs = [geo_config for geo_config in config_data["target_geos"].values() if geo_config["cities"]]
+    rnd = random.Random(1)
+    source_file = str(tmp_path / "test.jsonl")
+    with open(source_file, "w", encoding="utf-8") as f:
+        for record_id in range(RECORD_CNT):
+            geo_config = rnd.choice(geo_configs)
+            city, country = rnd.choice(geo_config["cities"]), rnd.choice(geo_config["countries"])
+            if rnd.random() < 0.5:
+                city, country = rnd.choice((("Paris", "FR"), ("Lagos", "NG"), (city, "FR")))
+            record = {"DATA_SOURCE": "TEST", "RECORD_ID": str(record_id), "RECORD_TYPE": "PERSON"}
+            if rnd.random() < 0.5:
+                record["ADDR_FULL"] = f"{record_id} Main St, {city.title()}, {country.upper()}"
+            else:
+                record.update({"ADDR_CITY": city.title(), "ADDR_COUNTRY": country.upper()})
+            f.write(json.dumps(record) + "\n")
+    config_data["source_files"] = {"test": source_file}
+    return config_data
+
+
+def run_extractor(monkeypatch, config_data, output_path, *args):
+    """Run geo_extractor.py on the test source for all geos, checkpointing as often as it can."""
+    config_data = {**config_data, "output_path": str(output_path)}
+    os.makedirs(output_path, exist_ok=True)
+    monkeypatch.setattr(geo_extractor, "load_config", lambda: GeoConfig(json.loads(json.dumps(config_data))))
+    monkeypatch.setattr(
+        sys, "argv", ["geo_extractor.py", "test", "all", "-f", "512", "--checkpoint-secs", "1e-6", *args]
+    )
+    geo_extractor.main()
+
+
+def output_files(output_path):
+    """Return the contents of each file of a run's output directory."""
+    contents = {}
+    for file_name in sorted(os.listdir(output_path)):
+        with open(output_path / file_name, "rb") as f:
+            contents[file_name] = f.read()
+    return contents
+
+
+def assert_resumed(output_path):
+    """Check an interrupted run left a checkpoint and partial outputs rather than finished ones."""
+    assert glob.glob(f"{output_path}/*.checkpoint")
+    assert glob.glob(f"{output_path}/*.jsonl*.part")
+    assert not glob.glob(f"{output_path}/*.jsonl")
+
+
+def test_resume_single_worker(monkeypatch, tmp_path, config_data):
+    """A single worker run stopped part way through a source carries on to the same outputs."""
+    run_extractor(monkeypatch, config_data, tmp_path / "uninterrupted")
+
+    match_record = GeoExtractor.match_record
+    match_cnt = 0
+
+    def interrupted_match_record(self, record, address_results=None):
+        nonlocal match_cnt
+        match_cnt += 1
+        if match_cnt == RECORD_CNT // 3:
+            raise KeyboardInterrupt
+        return match_record(self, record, address_results)
+
+    monkeypatch.setattr(GeoExtractor, "match_record", interrupted_match_record)
+    run_extractor(monkeypatch, config_data, tmp_path / "resumed")
+    assert_resumed(tmp_path / "resumed")
+    monkeypatch.setattr(GeoExtractor, "match_record", match_record)
+    run_extractor(monkeypatch, config_data, tmp_path / "resumed", "--resume")
+
+    assert output_files(tmp_path / "resumed") == output_files(tmp_path / "uninterrupted")
+
+
+def test_resume_sharded(monkeypatch, tmp_path, config_data):
+    """A sharded run stopped after merging its first shard carries on to the same outputs."""
+    run_extractor(monkeypatch, config_data, tmp_path / "uninterrupted", "-w", "3", "--ordered")
+
+    checkpoint_merge = shard_pool.checkpoint_merge
+
+    def interrupted_checkpoint_merge(*args):
+        checkpoint_merge(*args)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(shard_pool, "checkpoint_merge", interrupted_checkpoint_merge)
+    run_extractor(monkeypatch, config_data, tmp_path / "resumed", "-w", "3", "--ordered")
+    assert_resumed(tmp_path / "resumed")
+    monkeypatch.setattr(shard_pool, "checkpoint_merge", checkpoint_merge)
+    run_extractor(monkeypatch, config_data, tmp_path / "resumed", "-w", "3", "--ordered", "--resume")
+
+    assert output_files(tmp_path / "resumed") == output_files(tmp_path / "uninterrupted")